@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import json
+import os
+from os import environ as env
+from os import path
+
+from ada import log
+
+AIO_VALUES = env.get('AIO_VALUES_FILE', path.expanduser('~/.cache/adaio/aio_values.json'))
+
+
+class AioValues(object):
+    """ Last value forwarded to aio per group and feed, kept on disk across restarts.
+
+        It stands for what aio holds: a retained value that matches it does not
+        need forwarding again. File is replaced atomically, by save(), only when
+        something changed since the last save.
+    """
+
+    def __init__(self, filename=AIO_VALUES):
+        self.filename = filename
+        self.dirty = False
+        self.skipped = 0  # retained values not forwarded for matching
+        try:
+            with open(self.filename) as f:
+                self.values = json.load(f)
+        except (OSError, ValueError):
+            self.values = {}
+
+    @staticmethod
+    def _key(group_id, feed_id):
+        return "{}/{}".format(group_id, feed_id)
+
+    def matches(self, group_id, feed_id, payload):
+        return self.values.get(self._key(group_id, feed_id)) == str(payload)
+
+    def forwarded(self, group_id, feed_id, payload):
+        key = self._key(group_id, feed_id)
+        if self.values.get(key) != str(payload):
+            self.values[key] = str(payload)
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_filename = self.filename + '.tmp'
+        try:
+            os.makedirs(path.dirname(self.filename), mode=0o700, exist_ok=True)
+            with open(tmp_filename, 'w') as f:
+                json.dump(self.values, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.filename)
+            self.dirty = False
+        except OSError as e:
+            logger.warning("unable to save aio values %s: %s", self.filename, e)
+
+
+logger = log.getLogger()
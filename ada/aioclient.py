@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+import ssl
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from ada import log
+from ada import mqttv5
+from ada.backoff import Backoff
+
+ADAFRUIT_IO_HOST = 'io.adafruit.com'
+ADAFRUIT_IO_PORT = 8883
+KEEPALIVE = 60  # seconds
+PUBLISH_QOS = 1
+INFLIGHT_WINDOW = 20
+RECONNECT_MIN_DELAY = 1  # seconds
+RECONNECT_MAX_DELAY = 120  # seconds
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """ SSL context that offers the last TLS session when wrapping a new socket.
+
+        paho wraps a brand new socket on every reconnect. Offering the session
+        from the previous connection lets the server skip the full handshake.
+    """
+    session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.session is not None and 'session' not in kwargs:
+            kwargs['session'] = self.session
+        return super().wrap_socket(sock, *args, **kwargs)
+
+
+def tls_context(ca_certs=None):
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if ca_certs:
+        context.load_verify_locations(ca_certs)
+    else:
+        context.load_default_certs()
+    return context
+
+
+class AioClient(object):
+    """ Thin Adafruit IO mqtt client, on top of paho.
+
+        Feed and group topics are built once and interned. Publishes do not wait
+        for their acks: up to inflight_window QoS1 messages can be pending, and
+        the round trip time of each publish is measured when its ack arrives.
+
+        Reconnects are done by paho's network loop on the same client, with
+        exponential backoff plus jitter. With a stable client_id and
+        clean_session=False the broker keeps subscriptions across reconnects,
+        and the TLS session of the previous connection is offered for resumption.
+
+        With protocol MQTTv5 (only where the server supports it; io.adafruit.com
+        speaks 3.1.1), qos0 publishes on hot topics use topic aliases and all
+        publishes can carry a message expiry interval.
+    """
+
+    def __init__(self, username, key, host=ADAFRUIT_IO_HOST, port=ADAFRUIT_IO_PORT,
+                 secure=True, client_id="", qos=PUBLISH_QOS,
+                 inflight_window=INFLIGHT_WINDOW, keepalive=KEEPALIVE,
+                 clean_session=True, ssl_context=None, protocol=mqtt.MQTTv311,
+                 message_expiry=None):
+        self.username = username
+        self.host = host
+        self.port = port
+        self.qos = qos
+        self.keepalive = keepalive
+        self.protocol = protocol
+        self.clean_session = clean_session
+        self.message_expiry = message_expiry
+        self.topic_aliases = mqttv5.TopicAliases()
+        self.on_connect = None  # fun(client, rc)
+        self.on_disconnect = None  # fun(client, rc)
+        self.on_publish_rtt = None  # fun(client, mid, rtt)
+        self.on_reconnect_latency = None  # fun(client, latency)
+        self.session_present = False
+        self.tls_resumed = False
+        self.disconnect_ts = None  # monotonic ts of last disconnect, until a publish is acked
+        self._backoff = Backoff(RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY)
+
+        self._topics = {}  # (feed_id, group_id) -> topic
+        self._lock = threading.Lock()
+        self._inflight = {}  # mid -> monotonic ts of publish
+        self._early_acks = {}  # mid -> monotonic ts of ack, when ack beats publish return
+        self.rtt_count = 0
+        self.rtt_total = 0.0
+        self.rtt_max = 0.0
+
+        # persistent sessions need a stable client id
+        if not client_id:
+            self.clean_session = True
+        if protocol == mqtt.MQTTv5:
+            self._client = mqtt.Client(client_id=client_id, protocol=protocol)
+        else:
+            self._client = mqtt.Client(client_id=client_id, clean_session=self.clean_session)
+        self._ssl_context = None
+        if secure:
+            self._ssl_context = ssl_context or tls_context()
+            self._client.tls_set_context(self._ssl_context)
+        self._client.username_pw_set(username, key)
+        self._client.max_inflight_messages_set(inflight_window)
+        self._set_reconnect_delay()
+        self._client.on_connect = self._mqtt_connect
+        self._client.on_connect_fail = self._mqtt_connect_fail
+        self._client.on_disconnect = self._mqtt_disconnect
+        self._client.on_publish = self._mqtt_publish
+
+    # =========================================================================
+
+    def feed_topic(self, feed_id, group_id=None):
+        key = (feed_id, group_id)
+        topic = self._topics.get(key)
+        if topic is None:
+            if group_id:
+                topic = '{}/feeds/{}.{}'.format(self.username, group_id, feed_id)
+            else:
+                topic = '{}/feeds/{}'.format(self.username, feed_id)
+            topic = self._topics[key] = sys.intern(topic)
+        return topic
+
+    def group_topic(self, group_id):
+        return '{}/groups/{}'.format(self.username, group_id)
+
+    def randomizer_topic(self, randomizer_id):
+        return '{}/integration/words/{}'.format(self.username, randomizer_id)
+
+    # =========================================================================
+
+    def _set_reconnect_delay(self):
+        # paho doubles its delay without jitter, so feed it one jittered value at a time
+        delay = self._backoff.next_delay()
+        self._client.reconnect_delay_set(min_delay=delay, max_delay=delay)
+
+    def _mqtt_connect(self, _client, _userdata, flags, rc, properties=None):
+        self.topic_aliases.reset(mqttv5.topic_alias_maximum(properties))
+        if rc == mqtt.CONNACK_ACCEPTED:
+            self.session_present = bool(flags.get('session present'))
+            sock = self._client.socket()
+            if isinstance(sock, ssl.SSLSocket):
+                self.tls_resumed = sock.session_reused
+                # TLS 1.3 tickets arrive after the handshake, so the session is
+                # only worth keeping once the CONNACK was read
+                self._ssl_context.session = sock.session
+            self._backoff.reset()
+            self._set_reconnect_delay()
+        else:
+            self._set_reconnect_delay()
+        logger.debug("aio client connected rc %s session_present %s tls_resumed %s",
+                     rc, self.session_present, self.tls_resumed)
+        if self.on_connect:
+            self.on_connect(self, rc)
+
+    def _mqtt_connect_fail(self, _client, _userdata):
+        self._set_reconnect_delay()
+
+    def _mqtt_disconnect(self, _client, _userdata, rc, _properties=None):
+        logger.debug("aio client disconnected rc %s", rc)
+        self.topic_aliases.reset()
+        self._set_reconnect_delay()
+        with self._lock:
+            if self.disconnect_ts is None:
+                self.disconnect_ts = time.monotonic()
+            self._inflight.clear()
+            self._early_acks.clear()
+        if self.on_disconnect:
+            self.on_disconnect(self, rc)
+
+    def _mqtt_publish(self, _client, _userdata, mid):
+        # Note: called with paho's message lock held. Never publish from here.
+        ack_ts = time.monotonic()
+        with self._lock:
+            publish_ts = self._inflight.pop(mid, None)
+            if publish_ts is None:
+                self._early_acks[mid] = ack_ts
+                return
+        self._account_rtt(mid, ack_ts - publish_ts)
+
+    def _account_rtt(self, mid, rtt):
+        # Called from paho's thread and from the publishing thread. Callbacks run unlocked
+        latency = None
+        with self._lock:
+            if self.disconnect_ts is not None:
+                latency = time.monotonic() - self.disconnect_ts
+                self.disconnect_ts = None
+            self.rtt_count += 1
+            self.rtt_total += rtt
+            self.rtt_max = max(self.rtt_max, rtt)
+        if latency is not None and self.on_reconnect_latency:
+            self.on_reconnect_latency(self, latency)
+        if self.on_publish_rtt:
+            self.on_publish_rtt(self, mid, rtt)
+
+    def rtt_stats(self, reset=True):
+        """ Return count, average and max publish round trip time, in seconds """
+        with self._lock:
+            count, total, rtt_max = self.rtt_count, self.rtt_total, self.rtt_max
+            if reset:
+                self.rtt_count, self.rtt_total, self.rtt_max = 0, 0.0, 0.0
+        return count, (total / count if count else 0.0), rtt_max
+
+    @property
+    def inflight(self):
+        return len(self._inflight)
+
+    # =========================================================================
+
+    def connect(self):
+        if self.protocol == mqtt.MQTTv5:
+            properties = None if self.clean_session else mqttv5.connect_properties()
+            self._client.connect_async(self.host, port=self.port, keepalive=self.keepalive,
+                                       clean_start=self.clean_session, properties=properties)
+        else:
+            self._client.connect_async(self.host, port=self.port, keepalive=self.keepalive)
+
+    def loop_background(self):
+        self._client.loop_start()
+
+    def loop_stop(self):
+        self._client.loop_stop()
+
+    def disconnect(self):
+        self._client.disconnect()
+
+    def is_connected(self):
+        return self._client.is_connected()
+
+    def message_callback_add(self, topic_filter, callback):
+        self._client.message_callback_add(topic_filter, callback)
+
+    def subscribe(self, topic, qos=1):
+        return self._client.subscribe(topic, qos)
+
+    def publish(self, feed_id, value=None, group_id=None):
+        topic = self.feed_topic(feed_id, group_id)
+        properties = None
+        if self.protocol == mqtt.MQTTv5:
+            # qos0 only: a publish that is sent again on a new connection cannot use an alias
+            use_alias = self.qos == 0 and self._client.is_connected()
+            topic, properties = self.topic_aliases.publish_args(
+                topic, self.message_expiry, use_alias=use_alias)
+        publish_ts = time.monotonic()
+        info = self._client.publish(topic, value, self.qos, properties=properties)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return info
+        with self._lock:
+            ack_ts = self._early_acks.pop(info.mid, None)
+            if ack_ts is None:
+                self._inflight[info.mid] = publish_ts
+                return info
+        self._account_rtt(info.mid, ack_ts - publish_ts)
+        return info
+
+
+# =============================================================================
+
+
+logger = log.getLogger()
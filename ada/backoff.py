@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+import random
+
+
+class Backoff(object):
+    """ Exponential backoff with full jitter.
+
+        Each delay is picked at random between base and base * 2^attempt, capped.
+        Jitter keeps many clients (or many restarts) from retrying in lockstep.
+    """
+
+    def __init__(self, base=1.0, cap=120.0):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self):
+        upper = min(self.cap, self.base * (2 ** self.attempt))
+        if upper < self.cap:
+            self.attempt += 1
+        return random.uniform(self.base, max(self.base, upper))
+
+    def reset(self):
+        self.attempt = 0
@@ -21,6 +21,7 @@ AIO_UPTIME_MINUTES = 'device-uptime'
 
 AIO_LOCAL_CMD = "/aio/local/cmd"
 AIO_LOCAL_CMD_GET_LOCAL_TIME_WEATHER = "get_local_time_and_weather"
+AIO_LOCAL_CMD_REFRESH_SENSE = "refresh_sense"
 AIO_RING_CMD = "/aio/ring/cmd"
 AIO_RING_CMD_RESTART = "restart"
 AIO_LOCAL_EVBAYS = "/evbays"
@@ -108,6 +109,9 @@ AIO_TOPIC_RANDOMIZER = "{}/words".format(AIO_TOPIC_PREFIX)
 AIO_TOPIC_WEATHER_CURRENT = "{}/weather/current".format(AIO_TOPIC_PREFIX)
 AIO_TOPIC_LOCAL_TIME = "{}/local_time".format(AIO_TOPIC_PREFIX)
 
+# metrics are local only. They are not bridged to adafruit.io
+ADAIO_TOPIC_METRICS = "/adaio/metrics"
+
 # topics triggered from adafruit.io
 REMOTE_ENTRIES = [
     # not really an aio triggered event, but goes to aio and comes back to be handled
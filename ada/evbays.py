@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 import json
 import multiprocessing
+import os
 import signal
 import sys
+import threading
 
 from datetime import datetime, timedelta
 import dill
 from six.moves import queue
 
 from ada import events
+from ada import inotify
 from ada import log
 from os import environ as env
 from os import path
@@ -17,6 +20,11 @@ from os import path
 EVBAYS_FILE = "/vagrant/evbays/sema.json"
 CMDQ_SIZE = 100
 CMDQ_GET_TIMEOUT = 10  # seconds.
+# Polling is only a fallback once the watch has shown it sees changes, so it can
+# be slower then. Until it has, poll as usual: the file is on an sshfs mount, and
+# writes from the other side of it do not make inotify events here
+WATCH_POLL_INTERVAL = 60  # seconds.
+WATCH_MASK = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_ONLYDIR
 _state = None
 
 
@@ -30,7 +38,13 @@ class State(object):
         self.cmdq = multiprocessing.Queue(CMDQ_SIZE)  # queue for input commands
         self.evbays_fetch_interval = int(env.get("EVBAYS_INTERVAL", CMDQ_GET_TIMEOUT))
         self.evbays_filename = env.get("EVBAYS_FILE", EVBAYS_FILE)
+        self.evbays_watch = env.get("EVBAYS_WATCH", "yes") == "yes"
+        self.evbays_watch_poll_interval = int(
+            env.get("EVBAYS_WATCH_POLL_INTERVAL", WATCH_POLL_INTERVAL))
+        self.watcher = None  # thread, in the evbays process
+        self.watch_events = 0  # changes of the file the watcher saw
         self.last_fetch_mtime = None
+        self.last_fetch_stat = None  # file identity of last_fetch_payload
         self.last_fetch_ts = datetime.now()
         self.last_fetch_payload = None
 
@@ -60,12 +74,59 @@ def _notifyEVBaysEvent(payload):
 # =============================================================================
 
 
+def _watch(watcher, filename):
+    # Runs in its own thread. A new file is fetched as soon as it is in place
+    name = path.basename(filename)
+    try:
+        while True:
+            for _wd, mask, event_name in watcher.read():
+                if mask & inotify.IN_IGNORED:
+                    logger.warning("stopped watching %s: directory went away", filename)
+                    return
+                if event_name == name:
+                    logger.debug("%s changed: inotify mask 0x%x", filename, mask)
+                    _state.watch_events += 1
+                    do_fetch()
+    except Exception as e:
+        logger.error("stopped watching %s: %s", filename, e)
+    finally:
+        watcher.close()
+
+
+def _start_watcher():
+    global _state
+    try:
+        watcher = inotify.Inotify()
+        watcher.add_watch(path.dirname(_state.evbays_filename) or ".", WATCH_MASK)
+    except OSError as e:
+        logger.warning("cannot watch %s, polling every %s seconds: %s",
+                       _state.evbays_filename, _state.evbays_fetch_interval, e)
+        _state.evbays_watch = False
+        return
+    _state.watcher = threading.Thread(target=_watch, name="evbays-watch",
+                                      args=(watcher, _state.evbays_filename), daemon=True)
+    _state.watcher.start()
+    logger.info("watching %s, polling every %s seconds as a fallback once it sees changes",
+                _state.evbays_filename, _state.evbays_watch_poll_interval)
+
+
+def _poll_interval():
+    global _state
+    if _state.watch_events and _state.watcher and _state.watcher.is_alive():
+        return _state.evbays_watch_poll_interval
+    return _state.evbays_fetch_interval
+
+
 # external to this module
 def do_iterate():
     global _state
 
+    # once, from the evbays process itself
+    if _state.evbays_watch and not _state.watcher:
+        _start_watcher()
+
     try:
-        cmdDill = _state.cmdq.get(True, _state.evbays_fetch_interval)
+        cmdDill = _state.cmdq.get(True, _poll_interval())
         cmdFun, params = dill.loads(cmdDill)
         cmdFun(*params)
         logger.debug("executed a lambda command with params %s", params)
@@ -75,9 +136,7 @@ def do_iterate():
     except (KeyboardInterrupt, SystemExit):
         pass
 
-    if datetime.now() - _state.last_fetch_ts >= timedelta(
-        seconds=_state.evbays_fetch_interval
-    ):
+    if datetime.now() - _state.last_fetch_ts >= timedelta(seconds=_poll_interval()):
         _fetch()
 
 
@@ -97,11 +156,18 @@ def _fetch(force=False):
     global _state
 
     try:
-        mtime = path.getmtime(_state.evbays_filename)
+        # A new file is a new inode or mtime. The same one needs no reading
+        st = os.stat(_state.evbays_filename)
+        mtime = st.st_mtime
+        file_stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if not force and file_stat == _state.last_fetch_stat:
+            _state.last_fetch_ts = datetime.now()
+            return
         with open(_state.evbays_filename, "r", encoding="utf-8") as sema_file:
             payload = sema_file.read()
             data = json.loads(payload)
             _state.last_fetch_ts = datetime.now()
+            _state.last_fetch_stat = file_stat
             if (
                 force
                 or payload != _state.last_fetch_payload
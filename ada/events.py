@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import time
 
 
 class Base(object):
@@ -7,11 +8,13 @@ class Base(object):
         self.group = group
         self.description = description
         self.params = params or []
+        self.ts = time.time()  # when event was created, to measure queueing latency
 
 
 class MqttMsgEvent(Base):
-    def __init__(self, client_id, topic, payload):
-        params = [client_id, topic, payload]
+    def __init__(self, client_id, topic, payload, retained=False):
+        # retained is only set for local messages, when warm up is enabled
+        params = [client_id, topic, payload, retained]
         Base.__init__(self, "mqtt", "mqtt msg", params)
 
 
@@ -21,6 +24,19 @@ class MqttConnectEvent(Base):
         Base.__init__(self, "mqtt", "mqtt conn", params)
 
 
+class MqttPublishErrorEvent(Base):
+    def __init__(self, client_id, topic, reason):
+        params = [client_id, topic, reason]
+        Base.__init__(self, "mqtt", "mqtt publish error", params)
+
+
+class AioForwardedEvent(Base):
+    def __init__(self, group_id, feed_id, payload):
+        # payload as it came from the local broker, before any translation for aio
+        params = [group_id, feed_id, payload]
+        Base.__init__(self, "mqtt", "aio forwarded", params)
+
+
 class LocalTimeEvent(Base):
     def __init__(self, text, struct_time):
         params = [text, struct_time]
@@ -28,18 +44,32 @@ class LocalTimeEvent(Base):
 
 
 class OpenWeatherEvent(Base):
-    def __init__(self, payload):
-        params = [payload]
+    def __init__(self, payload, prefix):
+        params = [payload, prefix]
         Base.__init__(self, "open_weather", "weather", params)
 
 
 class SenseEnergyEvent(Base):
-    def __init__(self, key, value):
-        params = [key, value]
+    def __init__(self, changes):
+        # changes is a dict of topic -> value, for what changed since last snapshot
+        params = [changes]
         Base.__init__(self, "sense_energy", "sense_data", params)
 
 
+class SenseDeviceEvent(Base):
+    def __init__(self, prefix, device, state, ts, duration):
+        # duration is seconds the device spent in its previous state, None if unknown
+        params = [prefix, device, state, ts, duration]
+        Base.__init__(self, "sense_device", "sense device edge", params)
+
+
 class EVBaysEvent(Base):
     def __init__(self, payload):
         params = [payload]
         Base.__init__(self, "ev_bays", "ev bays update", params)
+
+
+class MetricEvent(Base):
+    def __init__(self, name, value):
+        params = [name, value]
+        Base.__init__(self, "metric", "metric", params)
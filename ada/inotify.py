@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len. Then len bytes of name
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify(object):
+    """ Linux inotify, through libc. Raises OSError where it is not available.
+
+        read() returns a list of (wd, mask, name) for the events that came
+        within timeout seconds, or an empty list.
+    """
+
+    def __init__(self):
+        try:
+            libc = _load_libc()
+            init1 = libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(errno.ENOSYS, "inotify not available: {}".format(e))
+        self.fd = _check(init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, filename, mask):
+        return _check(_libc.inotify_add_watch(self.fd, os.fsencode(filename), mask))
+
+    def read(self, timeout=None):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        found = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            found.append((wd, mask, os.fsdecode(name)))
+        return found
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # python < 3.9
+    ZoneInfo = None
+
+# Assumed worst case drift of the local oscillator, when it cannot be measured yet
+DRIFT_BOUND = 50e-6  # 50 ppm
+MAX_ERROR = 1.0  # seconds
+# Drift is only estimated from syncs that are at least this far apart
+MIN_DRIFT_INTERVAL = 600  # seconds
+
+# utc is seconds since epoch, uncertainty is how far off that sample may be (e.g. half rtt)
+TIME_SAMPLE = namedtuple("TIME_SAMPLE", "utc uncertainty utcoffset tzname")
+
+
+def parse_aio_strftime(text):
+    """ Parse the reply of aio time service into a TIME_SAMPLE.
+
+        Expected format is %Y-%m-%d %H:%M:%S.%L %j %u %z %Z , as in:
+        2021-05-29 08:26:41.123 149 6 -0400 EDT
+    """
+    times = text.split(" ")
+    dt = datetime.strptime("{} {} {}".format(times[0], times[1], times[4]),
+                           "%Y-%m-%d %H:%M:%S.%f %z")
+    tzname = times[5] if len(times) > 5 else None
+    return TIME_SAMPLE(dt.timestamp(), 0, dt.utcoffset(), tzname)
+
+
+def system_time_sample():
+    """ Fallback time source: the clock of this host. No network needed. """
+    now = datetime.now().astimezone()
+    return TIME_SAMPLE(now.timestamp(), 0, now.utcoffset(), now.tzname())
+
+
+class LocalClock(object):
+    """ Model of wall clock time, as offset and drift against time.monotonic()
+
+        A sync gives a utc sample. In between syncs, time is derived locally
+        and the estimated error grows with the elapsed monotonic time.
+    """
+
+    def __init__(self, tz_name=None, max_error=MAX_ERROR, drift_bound=DRIFT_BOUND):
+        self.max_error = max_error
+        self.drift_bound = drift_bound
+        self.tz = None
+        if tz_name and ZoneInfo:
+            try:
+                self.tz = ZoneInfo(tz_name)
+            except Exception:
+                self.tz = None
+        self.first_sync = None  # (monotonic, utc)
+        self.last_sync = None  # (monotonic, utc)
+        self.offset = None  # utc - monotonic, at last_sync
+        self.drift = 0.0  # seconds of error per monotonic second
+        self.uncertainty = 0.0
+        self.utcoffset = None
+        self.tzname = None
+        self.syncs = 0
+
+    def sync(self, sample, mono=None):
+        mono = time.monotonic() if mono is None else mono
+        if self.first_sync and mono - self.first_sync[0] >= MIN_DRIFT_INTERVAL:
+            first_mono, first_utc = self.first_sync
+            self.drift = ((sample.utc - first_utc) - (mono - first_mono)) / (mono - first_mono)
+        if not self.first_sync:
+            self.first_sync = (mono, sample.utc)
+        self.last_sync = (mono, sample.utc)
+        self.offset = sample.utc - mono
+        self.uncertainty = sample.uncertainty
+        self.utcoffset = sample.utcoffset
+        self.tzname = sample.tzname
+        self.syncs += 1
+
+    @property
+    def is_synced(self):
+        return self.last_sync is not None
+
+    def estimated_error(self, mono=None):
+        if not self.is_synced:
+            return float("inf")
+        mono = time.monotonic() if mono is None else mono
+        elapsed = mono - self.last_sync[0]
+        return self.uncertainty + elapsed * self.drift_bound
+
+    def needs_sync(self, mono=None):
+        return self.estimated_error(mono) > self.max_error
+
+    def utc(self, mono=None):
+        mono = time.monotonic() if mono is None else mono
+        elapsed = mono - self.last_sync[0]
+        return mono + self.offset + elapsed * self.drift
+
+    def now(self, mono=None):
+        """ Return local time as (text, struct_time), same as aio time service would """
+        utc = datetime.fromtimestamp(self.utc(mono), tz=timezone.utc)
+        if self.tz:
+            local = utc.astimezone(self.tz)
+        else:
+            offset = self.utcoffset or timedelta(0)
+            # no %Z in the aio reply: timezone() takes no None name
+            tz = timezone(offset, self.tzname) if self.tzname else timezone(offset)
+            local = utc.astimezone(tz)
+        text = "{}.{:03d} {} {} {} {}".format(
+            local.strftime("%Y-%m-%d %H:%M:%S"), local.microsecond // 1000,
+            local.strftime("%j"), local.isoweekday(), local.strftime("%z"), local.tzname())
+        is_dst = None  # no way to know yet
+        struct_time = time.struct_time(
+            (local.year, local.month, local.day, local.hour, local.minute, local.second,
+             local.isoweekday(), local.timetuple().tm_yday, is_dst)
+        )
+        return text, struct_time
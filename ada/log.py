@@ -1,8 +1,25 @@
 #!/usr/bin/env python
+import atexit
 import logging
-from logging.handlers import SysLogHandler
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, SysLogHandler
+from os import environ as env
 from os import path
 
+QUEUE_SIZE = 10000  # records waiting for the writer thread. Beyond that they are dropped
+REPORT_INTERVAL = 300  # seconds between lines about suppressed and dropped records
+RATE = 5.0  # INFO and below lines per second, per call site
+BURST = 20  # lines a call site can log at once before being rate limited
+SAMPLE = 100  # while rate limited, let one of every SAMPLE lines through
+
+_writer = None
+_queue_handler = None
+_rate_filter = None
+_stats_reporter = None
+
 
 def getLogger():
     return logging.getLogger('adaio')
@@ -16,7 +33,167 @@ def _log_handler_address(files=tuple()):
     raise Exception("Invalid files: %s" % ", ".join(files))
 
 
+class RateLimitFilter(logging.Filter):
+    """ Token bucket per call site for INFO and below. Sampled lines that get
+        through while a call site is limited say how many lines were suppressed.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, sample=SAMPLE):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.reset()
+
+    def reset(self):
+        self.suppressed = 0
+        self._sites = {}  # (pathname, lineno) -> [tokens, last_ts, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = [self.burst, now, 0]
+            site[0] = min(self.burst, site[0] + (now - site[1]) * self.rate)
+            site[1] = now
+            if site[0] < 1:
+                site[2] += 1
+                if not self.sample or site[2] % self.sample:
+                    self.suppressed += 1
+                    return False
+                site[2] -= 1
+            else:
+                site[0] -= 1
+            suppressed, site[2] = site[2], 0
+        if suppressed:
+            record.msg = "%s [suppressed %d similar]" % (record.msg, suppressed)
+        return True
+
+
+class _DroppingQueueHandler(QueueHandler):
+    def __init__(self, record_queue):
+        QueueHandler.__init__(self, record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens in the writer thread. Records never leave this
+        # process, so there is no need to make them picklable here.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Writer(QueueListener):
+    """ Background thread handing queued records over to the real handlers """
+
+    def __init__(self, record_queue, handlers):
+        QueueListener.__init__(self, record_queue, respect_handler_level=True)
+        self.handlers = list(handlers)
+        self._reported = (0, 0)
+        self._report_ts = time.monotonic()
+
+    def enqueue_sentinel(self):
+        # queue may be full. Wait for room, so what is queued gets written
+        self.queue.put(self._sentinel)
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, REPORT_INTERVAL)
+            except queue.Empty:
+                pass
+            finally:
+                self._maybe_report()
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        if now - self._report_ts < REPORT_INTERVAL:
+            return
+        self._report_ts = now
+        if _stats_reporter is not None:
+            _stats_reporter(stats())
+        reported = stats()[1:]
+        if reported != self._reported:
+            dropped, suppressed = (n - r for n, r in zip(reported, self._reported))
+            self._reported = reported
+            record = getLogger().makeRecord(
+                getLogger().name, logging.WARNING, __file__, 0,
+                "log lines suppressed %d dropped %d", (suppressed, dropped), None)
+            self.handle(record)
+
+
+def _start_writer(handlers):
+    global _writer, _queue_handler
+    record_queue = queue.Queue(QUEUE_SIZE)
+    if _queue_handler is None:
+        _queue_handler = _DroppingQueueHandler(record_queue)
+        getLogger().addHandler(_queue_handler)
+    else:
+        _queue_handler.queue = record_queue
+    _writer = _Writer(record_queue, handlers)
+    _writer.start()
+
+
+def _restart_writer_in_child():
+    # A forked process has none of its parent's threads. Give it its own writer.
+    global _writer
+    if _rate_filter is not None:
+        _rate_filter.reset()
+    set_stats_reporter(None)
+    if _writer is not None:
+        handlers, _writer = _writer.handlers, None
+        _queue_handler.dropped = 0
+        _start_writer(handlers)
+
+
+def _add_handler(handler):
+    if _writer is not None:
+        _writer.handlers.append(handler)
+    else:
+        getLogger().addHandler(handler)
+
+
+def flush():
+    """ Stop the writer after it handled what is queued. Later records are written synchronously """
+    global _writer, _queue_handler
+    if _writer is None:
+        return
+    _writer.stop()
+    getLogger().removeHandler(_queue_handler)
+    for handler in _writer.handlers:
+        getLogger().addHandler(handler)
+    _writer = _queue_handler = None
+
+
+def set_stats_reporter(fun):
+    """ Have the writer thread call fun(stats()) every REPORT_INTERVAL, in this process """
+    global _stats_reporter
+    _stats_reporter = fun
+
+
+def stats():
+    """ Return tuple: records waiting, records dropped, lines suppressed by rate limit """
+    waiting = _queue_handler.queue.qsize() if _queue_handler else 0
+    dropped = _queue_handler.dropped if _queue_handler else 0
+    suppressed = _rate_filter.suppressed if _rate_filter else 0
+    return waiting, dropped, suppressed
+
+
+def use_writer_thread():
+    return env.get('LOG_WRITER_THREAD', 'yes') == 'yes'
+
+
 def initLogger(testing=False):
+    global _rate_filter
     logger = getLogger()
     logger.setLevel(logging.INFO)
     log_format = '%(asctime)s [adaio] %(module)12s:%(lineno)-d %(levelname)-8s %(message)s'
@@ -28,7 +205,18 @@ def initLogger(testing=False):
     syslog = SysLogHandler(address=logHandlerAddress,
                            facility=SysLogHandler.LOG_DAEMON)
     syslog.setFormatter(formatter)
-    logger.addHandler(syslog)
+    if use_writer_thread():
+        _start_writer([syslog])
+        os.register_at_fork(after_in_child=_restart_writer_in_child)
+        atexit.register(flush)
+    else:
+        logger.addHandler(syslog)
+
+    rate = float(env.get('LOG_RATE', RATE))
+    if rate:
+        _rate_filter = RateLimitFilter(rate, int(env.get('LOG_BURST', BURST)),
+                                       int(env.get('LOG_SAMPLE', SAMPLE)))
+        logger.addFilter(_rate_filter)
     if testing:
         log_to_console()
         set_log_level_debug()
@@ -39,7 +227,7 @@ def log_to_console():
     log_format = '%(asctime)s %(module)12s:%(lineno)-d %(levelname)-8s %(message)s'
     formatter = logging.Formatter(log_format)
     consoleHandler.setFormatter(formatter)
-    getLogger().addHandler(consoleHandler)
+    _add_handler(consoleHandler)
 
 
 def set_log_level_debug():
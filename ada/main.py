@@ -2,6 +2,7 @@
 import copy
 import json
 import multiprocessing
+import signal
 import subprocess
 import time
 from datetime import datetime, timedelta
@@ -17,10 +18,10 @@ from ada import evbays_state
 from ada import events
 from ada import log
 from ada import mqttadaio
-from ada import mqttadaiothrottle
 from ada import mqttclient
 from ada import oweather
 from ada import senseenergy
+from ada.aio_values import AioValues
 
 EVENTQ_SIZE = 1000
 EVENTQ_GET_TIMEOUT = 15  # seconds
@@ -33,6 +34,40 @@ class ProcessBase(multiprocessing.Process):
         self.eventq = eventq_param
         self.cmdq = None
         self.disconnect_ts = None
+        self.stopping = False
+
+    def run(self):
+        # Children leave through os._exit, which skips atexit. Have SIGTERM end
+        # the loop, and hand what the log writer has queued to syslog on the
+        # way out.
+        signal.signal(signal.SIGTERM, self._terminate_requested)
+        log.set_stats_reporter(self._report_log_stats)
+        logger.debug("%s started", self.__class__.__name__)
+        try:
+            while not self.stopping:
+                self.iterate()
+        except Exception as e:
+            logger.error("%s exiting: %s", self.__class__.__name__, e)
+            raise
+        finally:
+            log.flush()
+
+    def iterate(self):
+        raise NotImplementedError
+
+    def _terminate_requested(self, _signum, _frame):
+        self.stopping = True
+        raise SystemExit("terminated")
+
+    def _report_log_stats(self, stats):
+        name = self.__class__.__name__.replace('Process', '').lower()
+        waiting, dropped, suppressed = stats
+        try:
+            self.putEvent(events.MetricEvent('log_waiting_' + name, waiting))
+            self.putEvent(events.MetricEvent('log_dropped_' + name, dropped))
+            self.putEvent(events.MetricEvent('log_suppressed_' + name, suppressed))
+        except RuntimeError:
+            pass  # the main loop notices the full queue on its own
 
     def putEvent(self, event):
         try:
@@ -51,10 +86,8 @@ class MqttclientProcess(ProcessBase):
         ProcessBase.__init__(self, const.MQTT_CLIENT_LOCAL, eventq_param)
         self.cmdq = mqttclient.do_init(self.putEvent)
 
-    def run(self):
-        logger.debug("mqttclient process started")
-        while True:
-            mqttclient.do_iterate()
+    def iterate(self):
+        mqttclient.do_iterate()
 
 
 class MqttAdaIoProcess(ProcessBase):
@@ -62,21 +95,8 @@ class MqttAdaIoProcess(ProcessBase):
         ProcessBase.__init__(self, const.MQTT_CLIENT_AIO, eventq_param)
         self.cmdq = mqttadaio.do_init(self.putEvent)
 
-    def run(self):
-        logger.debug("mqtt ada io process started")
-        while True:
-            mqttadaio.do_iterate()
-
-
-class MqttAdaIoThrottleProcess(ProcessBase):
-    def __init__(self, eventq_param):
-        ProcessBase.__init__(self, const.MQTT_CLIENT_AIO_THROTTLE, eventq_param)
-        self.cmdq = mqttadaiothrottle.do_init(self.putEvent)
-
-    def run(self):
-        logger.debug("mqtt ada io throttle process started")
-        while True:
-            mqttadaiothrottle.do_iterate()
+    def iterate(self):
+        mqttadaio.do_iterate()
 
 
 class OWeatherProcess(ProcessBase):
@@ -84,10 +104,8 @@ class OWeatherProcess(ProcessBase):
         ProcessBase.__init__(self, None, eventq_param)
         self.cmdq = oweather.do_init(self.putEvent)
 
-    def run(self):
-        logger.debug("openweather process started")
-        while True:
-            oweather.do_iterate()
+    def iterate(self):
+        oweather.do_iterate()
 
 
 class SenseEnergyProcess(ProcessBase):
@@ -95,10 +113,8 @@ class SenseEnergyProcess(ProcessBase):
         ProcessBase.__init__(self, None, eventq_param)
         self.cmdq = senseenergy.do_init(self.putEvent)
 
-    def run(self):
-        logger.debug("sense energy process started")
-        while True:
-            senseenergy.do_iterate()
+    def iterate(self):
+        senseenergy.do_iterate()
 
 
 class EVBaysProcess(ProcessBase):
@@ -106,10 +122,8 @@ class EVBaysProcess(ProcessBase):
         ProcessBase.__init__(self, None, eventq_param)
         self.cmdq = evbays.do_init(self.putEvent)
 
-    def run(self):
-        logger.debug("evbays process started")
-        while True:
-            evbays.do_iterate()
+    def iterate(self):
+        evbays.do_iterate()
 
     @staticmethod
     def do_fetch_now():
@@ -174,6 +188,10 @@ def handle_aio_cmd(_feed_id, payload):
         logger.debug("Got explicit request to get time and weather")
         _fetch_local_time()
         oweather.do_fetch()
+    elif payload == const.AIO_LOCAL_CMD_REFRESH_SENSE:
+        logger.debug("Got explicit request to refresh sense energy")
+        if senseenergy.use_sense_energy():
+            senseenergy.do_fetch(force=True)
     # Return none so there is not a publish to aio from this
     return None, None
 
@@ -267,11 +285,27 @@ def _get_process(client_id):
             return p
 
 
+def _publish_to_aio(feed_id, payload, group_id, retained):
+    # a retained value aio already got, before a restart or a broker replay
+    if aio_values and retained and aio_values.matches(group_id, feed_id, payload):
+        aio_values.skipped += 1
+        logger.debug("aio already has %s %s %s", group_id, feed_id, payload)
+        return
+    # recorded on AioForwardedEvent: a publish while aio is not connected is dropped
+    mqttadaio.publish(feed_id, payload, group_id, report=aio_values is not None)
+
+
+def processAioForwardedEvent(group_id, feed_id, payload):
+    if aio_values:
+        aio_values.forwarded(group_id, feed_id, payload)
+
+
 # TODO(flaviof): this needs to be more generic
-def processMqttMsgEvent(client_id, topic, payload):
+def processMqttMsgEvent(client_id, topic, payload, retained=False):
     global scheduler
 
-    logger.debug("processMqttMsgEvent %s %s %s", client_id, topic, payload)
+    logger.debug("processMqttMsgEvent %s %s %s%s", client_id, topic, payload,
+                 " retained" if retained else "")
     if client_id == const.MQTT_CLIENT_LOCAL:
         payload_handlers = {
             const.AIO_HOME_SOLAR_RATE: handle_solar_rate,
@@ -297,10 +331,13 @@ def processMqttMsgEvent(client_id, topic, payload):
             group_ids = topic_entry.group_id if isinstance(topic_entry.group_id, list) else [
                 topic_entry.group_id]
             for group_id in group_ids:
+                if retained and group_id in (const.AIO_LOCAL_CMD, const.AIO_RING_CMD):
+                    logger.info("not running retained command %s %s", topic, payload)
+                    continue
                 if group_id in payload_handlers:
                     feed_id, payload = payload_handlers[group_id](feed_id, payload)
                 if feed_id and payload is not None:
-                    mqttadaio.publish(feed_id, payload, group_id)
+                    _publish_to_aio(feed_id, payload, group_id, retained)
                 payload = copy.copy(payload_copy)
     elif client_id == const.MQTT_CLIENT_AIO_THROTTLE:
         logger.warning("getting hot: %s %s", topic, payload)
@@ -344,8 +381,13 @@ def processMqttConnEvent(client_id, event, rc):
             if evbays.use_evbays():
                 bays_state.clear_cache()
     elif client_id == const.MQTT_CLIENT_LOCAL:
-        oweather.do_fetch()
-        senseenergy.do_fetch()
+        if event == const.MQTT_CONNECTED:
+            # broker may have lost its retained weather: publish all of it again
+            weather_published.clear()
+            oweather.do_fetch()
+            if senseenergy.use_sense_energy():
+                # broker may have lost the sense values: send the cached ones, no refetch
+                senseenergy.do_resend()
 
     p = _get_process(client_id)
     if p:
@@ -356,9 +398,18 @@ def processMqttConnEvent(client_id, event, rc):
             p.disconnect_ts = datetime.now()
 
 
+def processMqttPublishErrorEvent(client_id, topic, reason):
+    global publish_errors
+    publish_errors[client_id] = publish_errors.get(client_id, 0) + 1
+    logger.warning("processMqttPublishErrorEvent client_id: %s topic: %s reason: %s errors: %d",
+                   client_id, topic, reason, publish_errors[client_id])
+
+
 def processEventMqttClient(event):
     syncFunHandlers = {"MqttMsgEvent": processMqttMsgEvent,
-                       "MqttConnectEvent": processMqttConnEvent, }
+                       "MqttConnectEvent": processMqttConnEvent,
+                       "MqttPublishErrorEvent": processMqttPublishErrorEvent,
+                       "AioForwardedEvent": processAioForwardedEvent, }
     cmdFun = syncFunHandlers.get(event.name)
     if not cmdFun:
         logger.warning("Don't know how to process event %s: %s", event.name, event.description)
@@ -378,12 +429,63 @@ def processEventLocalTime(event):
     mqttclient.do_mqtt_publish(const.AIO_TOPIC_LOCAL_TIME, time_text)
 
 
+def _publish_metric(name, value):
+    mqttclient.do_mqtt_publish("{}/{}".format(const.ADAIO_TOPIC_METRICS, name), value)
+
+
+def processMetricEvent(event):
+    if event.name != "MetricEvent":
+        logger.warning("Don't know how to process event %s: %s", event.name, event.description)
+        return
+    name, value = event.params
+    logger.debug(f"processMetricEvent: {name} = {value}")
+    _publish_metric(name, value)
+
+
+def _account_inbound_latency(event):
+    # time from the paho callback in the child process until the main loop got the event
+    global inbound_latency
+    latency = time.time() - event.ts
+    count, total, latency_max = inbound_latency
+    inbound_latency = (count + 1, total + latency, max(latency_max, latency))
+
+
+def _report_inbound_latency():
+    global inbound_latency
+    count, total, latency_max = inbound_latency
+    if not count:
+        return
+    inbound_latency = (0, 0.0, 0.0)
+    logger.debug("inbound mqtt messages %d latency avg %.4f max %.4f seconds",
+                 count, total / count, latency_max)
+    _publish_metric('inbound_latency_avg', round(total / count, 4))
+    _publish_metric('inbound_latency_max', round(latency_max, 4))
+
+
+def _report_log_stats():
+    waiting, dropped, suppressed = log.stats()
+    _publish_metric('log_waiting', waiting)
+    _publish_metric('log_dropped', dropped)
+    _publish_metric('log_suppressed', suppressed)
+
+
+def _report_weather_skipped():
+    _publish_metric('weather_skipped', weather_skipped)
+
+
+def _save_aio_values():
+    if not aio_values:
+        return
+    aio_values.save()
+    _publish_metric('aio_retained_skipped', aio_values.skipped)
+
+
 def processOWeatherEvent(event):
     if event.name != "OpenWeatherEvent":
         logger.warning("Don't know how to process event %s: %s", event.name, event.description)
         return
-    payload = event.params[0]
-    logger.info("processOWeatherEvent: {}".format(payload))
+    payload, prefix = event.params
+    logger.info("processOWeatherEvent: {} {}".format(prefix, payload))
     oweather_topics = {'raw': json.dumps(payload)}
 
     # {'coord': {'lon': -tiki.2278, 'lat': -tiki.5311},
@@ -415,15 +517,33 @@ def processOWeatherEvent(event):
     for k, v in data_main.items():
         oweather_topics[k] = v
 
-    for topic, mqtt_payload in oweather_topics.items():
-        mqttclient.do_mqtt_publish('/openweather/{}'.format(topic), mqtt_payload)
+    mqtt_entries = [('{}/{}'.format(prefix, topic), mqtt_payload)
+                    for topic, mqtt_payload in oweather_topics.items()]
 
-    logger.debug("translating oweather into aio weather")
-    try:
-        aioweather_payload = oweather_to_aioweather(payload)
-        mqttclient.do_mqtt_publish(const.AIO_TOPIC_WEATHER_CURRENT, json.dumps(aioweather_payload))
-    except ValueError as e:
-        logger.warning("unable to translate oweather to aio weather %s", e)
+    # only the first location is the current weather
+    if prefix == oweather.TOPIC_PREFIX:
+        logger.debug("translating oweather into aio weather")
+        try:
+            aioweather_payload = oweather_to_aioweather(payload)
+            mqtt_entries.append((const.AIO_TOPIC_WEATHER_CURRENT,
+                                 json.dumps(aioweather_payload)))
+        except ValueError as e:
+            logger.warning("unable to translate oweather to aio weather %s", e)
+    _publish_weather_changes(mqtt_entries)
+
+
+def _publish_weather_changes(mqtt_entries):
+    # Retained, so subscribers that come later still get the fields left out here
+    global weather_skipped
+    changed = [(topic, mqtt_payload) for topic, mqtt_payload in mqtt_entries
+               if weather_published.get(topic) != mqtt_payload]
+    weather_skipped += len(mqtt_entries) - len(changed)
+    if not changed:
+        logger.debug("weather did not change")
+        return
+    # a full command queue publishes nothing: keep the fields for the next time
+    if mqttclient.do_mqtt_publish_many(changed, retain=True):
+        weather_published.update(changed)
 
 def oweather_to_aioweather(ow):
     aiow = {}
@@ -449,10 +569,22 @@ def processSenseEnergyEvent(event):
     if event.name != "SenseEnergyEvent":
         logger.warning("Don't know how to process event %s: %s", event.name, event.description)
         return
-    key = event.params[0]
-    value = event.params[1]
-    logger.info(f"processSenseEnergyEvent: {key} = {value}")
-    mqttclient.do_mqtt_publish(key, value)
+    changes = event.params[0]
+    logger.info(f"processSenseEnergyEvent: {changes}")
+    mqttclient.do_mqtt_publish_many(changes.items())
+
+
+def processSenseDeviceEvent(event):
+    if event.name != "SenseDeviceEvent":
+        logger.warning("Don't know how to process event %s: %s", event.name, event.description)
+        return
+    prefix, device, state, ts, duration = event.params
+    logger.info(f"processSenseDeviceEvent: {prefix} {device} {state} after {duration}")
+    mqttclient.do_mqtt_publish_many([
+        (f"{prefix}/device/{device}", state),
+        (f"{prefix}/transition/{device}",
+         json.dumps({'state': state, 'ts': ts, 'duration': duration})),
+    ])
 
 
 def processEVBaysEvent(event):
@@ -522,7 +654,9 @@ def processEvent(event):
                        "local_time": processEventLocalTime,
                        "open_weather": processOWeatherEvent,
                        "sense_energy": processSenseEnergyEvent,
+                       "sense_device": processSenseDeviceEvent,
                        "ev_bays": processEVBaysEvent,
+                       "metric": processMetricEvent,
                        }
     cmdFun = syncFunHandlers.get(event.group)
     if not cmdFun:
@@ -558,6 +692,8 @@ def processEvents(timeout):
         event = eventq.get(True, timeout)
         if isinstance(event, events.Base):
             # logger.debug("Process event for %s", type(event))
+            if event.name == "MqttMsgEvent":
+                _account_inbound_latency(event)
             processEvent(event)
         else:
             logger.warning("Ignoring unexpected event: %s", event)
@@ -586,9 +722,15 @@ def main():
             processEvents(EVENTQ_GET_TIMEOUT)
             if should_check_children:
                 check_child_processes()
+                _report_inbound_latency()
+                _report_log_stats()
+                _report_weather_skipped()
+                _save_aio_values()
                 should_check_children = False
     except Exception as e:
         logger.error("Unexpected event: %s", e)
+    if aio_values:
+        aio_values.save()
     scheduler.shutdown(wait=False)
     # make sure all children are terminated
     [p.terminate() for p in myProcesses]
@@ -602,6 +744,11 @@ myProcesses = []
 scheduler = None
 should_check_children = False
 bays_state = None
+publish_errors = {}
+inbound_latency = (0, 0.0, 0.0)  # count, total, max
+weather_published = {}  # topic -> weather payload last published
+weather_skipped = 0  # weather publishes left out for not changing
+aio_values = None  # last values forwarded to aio, with warm up from retained messages
 
 if __name__ == "__main__":
     logger = log.getLogger()
@@ -614,9 +761,10 @@ if __name__ == "__main__":
 
     logger.debug("adaio process started")
     eventq = multiprocessing.Queue(EVENTQ_SIZE)
+    if mqttclient.use_warmup():
+        aio_values = AioValues()
     myProcesses.append(MqttclientProcess(eventq))
     myProcesses.append(MqttAdaIoProcess(eventq))
-    myProcesses.append(MqttAdaIoThrottleProcess(eventq))
     myProcesses.append(OWeatherProcess(eventq))
     if senseenergy.use_sense_energy():
         myProcesses.append(SenseEnergyProcess(eventq))
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-from datetime import datetime
+from datetime import datetime, timedelta
 import multiprocessing
 from ratelimiter import RateLimiter
 import requests
@@ -8,16 +8,20 @@ import sys
 import time
 
 import dill
+import paho.mqtt.client as mqtt
 from six.moves import queue
 import stopit
 
 from ada import const
 from ada import events
+from ada import localclock
 from ada import log
+from ada import mqttv5
 from os import environ as env
 
-# Import Adafruit IO MQTT client. It is actually an mqtt client wrapper.
-from Adafruit_IO import MQTTClient
+from ada.aioclient import AioClient
+from ada import aioclient
+
 from Adafruit_IO import Client as RestClient
 from Adafruit_IO import RequestError as RestRequestError
 
@@ -25,11 +29,29 @@ ADAFRUIT_IO_KEY = env['IO_KEY']
 ADAFRUIT_IO_USERNAME = env['IO_USERNAME']
 ADAFRUIT_IO_TIMEZONE = env.get('IO_TIMEZONE', 'America/New_York')
 ADAFRUIT_IO_RANDOM_ID = env.get('IO_RANDOM_ID')
+# Use 'system' to avoid network calls to aio time service
+ADAFRUIT_IO_TIME_SOURCE = env.get('IO_TIME_SOURCE', 'aio')
+ADAFRUIT_IO_TIME_MAX_ERROR = float(env.get('IO_TIME_MAX_ERROR', localclock.MAX_ERROR))
+# Knobs for the mqtt session. Host and port can point to a local broker for verification.
+ADAFRUIT_IO_MQTT_HOST = env.get('IO_MQTT_HOST', aioclient.ADAFRUIT_IO_HOST)
+ADAFRUIT_IO_MQTT_PORT = int(env.get('IO_MQTT_PORT', aioclient.ADAFRUIT_IO_PORT))
+ADAFRUIT_IO_MQTT_SECURE = env.get('IO_MQTT_SECURE', 'yes') == 'yes'
+ADAFRUIT_IO_PUBLISH_QOS = int(env.get('IO_PUBLISH_QOS', aioclient.PUBLISH_QOS))
+ADAFRUIT_IO_INFLIGHT_WINDOW = int(env.get('IO_INFLIGHT_WINDOW', aioclient.INFLIGHT_WINDOW))
+ADAFRUIT_IO_MQTT_CA_CERTS = env.get('IO_MQTT_CA_CERTS')
+# A stable client id lets the broker keep our session (and subscriptions) across reconnects
+ADAFRUIT_IO_MQTT_CLIENT_ID = env.get('IO_MQTT_CLIENT_ID', 'adaio-{}'.format(ADAFRUIT_IO_USERNAME))
+ADAFRUIT_IO_MQTT_CLEAN_SESSION = env.get('IO_MQTT_CLEAN_SESSION', 'no') == 'yes'
+# io.adafruit.com speaks 3.1.1. Use '5' only against a server that supports it.
+ADAFRUIT_IO_MQTT_PROTOCOL = mqttv5.protocol_from_env(env.get('IO_MQTT_PROTOCOL'))
+ADAFRUIT_IO_MQTT_MESSAGE_EXPIRY = int(env.get('IO_MQTT_MESSAGE_EXPIRY', '0')) or None
 
 CMDQ_SIZE = 900
 CMDQ_GET_TIMEOUT = 300    # seconds
-CONNECT_TIMEOUT = 180     # seconds
+# paho reconnects on its own, with backoff. Client is only rebuilt as a last resort.
+CONNECT_TIMEOUT = 900     # seconds
 RE_SUBSCRIBE_TIME = 1201  # seconds
+STATS_INTERVAL = 900      # seconds
 _state = None
 
 TIME_SERVICE = (
@@ -42,18 +64,25 @@ TIME_SERVICE_STRFTIME = (
 )
 
 class State(object):
-    def __init__(self, queueEventFun, feed_ids, group_ids, forecasts):
+    def __init__(self, queueEventFun, feed_ids, group_ids, forecasts, system_topics):
         self.queueEventFun = queueEventFun  # queue for output events
         self.cmdq = multiprocessing.Queue(CMDQ_SIZE)  # queue for input commands
         self.feed_ids = feed_ids
         self.group_ids = group_ids
         self.forecasts = forecasts
+        self.system_topics = system_topics
         self.aio_client = None
         self.aio_client_connected = False
         self.aio_client_update_ts = None
+        # kept across clients, so even a rebuilt client can resume the TLS session
+        self.aio_tls_context = None
         self.aio_rest_client = None
         self.aio_rest_feeds = set()
         self.lastMsgTimeStamp = None
+        self.stats_ts = datetime.now()
+        self.callback_error = None
+        self.local_clock = localclock.LocalClock(ADAFRUIT_IO_TIMEZONE,
+                                                 max_error=ADAFRUIT_IO_TIME_MAX_ERROR)
 
     @property
     def mqtt_client_id(self):
@@ -71,8 +100,12 @@ def do_init(queueEventFun=None):
     group_ids = {}
     # forecasts = ['current', 'forecast_hours_2', 'forecast_days_1', 'forecast_days_2']
     forecasts = ['current']
+    # errors and throttle notifications share the same aio session as the data feeds
+    system_topics = ['{}/errors'.format(ADAFRUIT_IO_USERNAME),
+                     '{}/throttle'.format(ADAFRUIT_IO_USERNAME),
+                     ]
 
-    _state = State(queueEventFun, feed_ids, group_ids, forecasts)
+    _state = State(queueEventFun, feed_ids, group_ids, forecasts, system_topics)
     # logger.debug("mqtt io client init called")
     return _state.cmdq
 
@@ -92,7 +125,22 @@ def _notifyMqttMsgEvent(topic, payload):
     logger.info("got mqtt message %s %s", topic, payload)
     # reset timestamp used to checkpoint how long since a msg was received from adafruit.io
     _state.lastMsgTimeStamp = datetime.now()
-    _notifyEvent(events.MqttMsgEvent(_state.mqtt_client_id, topic, payload))
+    _notifyEventFromCallback(events.MqttMsgEvent(_state.mqtt_client_id, topic, payload))
+
+
+def _notifyMqttSystemMsgEvent(topic, payload):
+    global _state
+    # filter out topics that we do not care about, before building any event
+    if topic not in _state.system_topics:
+        logger.warning("ignoring mqtt system message %s %s", topic, payload)
+        return
+    logger.debug("got mqtt system message %s %s", topic, payload)
+    # system topics are reported as if coming from the former throttle client
+    _notifyEventFromCallback(events.MqttMsgEvent(const.MQTT_CLIENT_AIO_THROTTLE, topic, payload))
+
+
+def _notifyMetricEvent(name, value):
+    _notifyEvent(events.MetricEvent(name, value))
 
 
 def _notifyEvent(event):
@@ -101,13 +149,90 @@ def _notifyEvent(event):
         _state.queueEventFun(event)
 
 
+def _notifyEventFromCallback(event):
+    # Runs in paho's thread. A failure here must still stop this process, so it is
+    # raised again from do_iterate, woken up for it
+    global _state
+    try:
+        _notifyEvent(event)
+    except RuntimeError as e:
+        logger.error("unable to notify event from callback: %s", e)
+        _state.callback_error = e
+        _enqueue_cmd((_raise_callback_error, []))
+
+
+def _raise_callback_error():
+    raise _state.callback_error
+
+
 # =============================================================================
 
 
-def client_message_callback(_client, topic, payload):
-    # logger.debug("callback for mqtt message %s %s", topic, payload)
-    params = [topic, payload]
-    _enqueue_cmd((_notifyMqttMsgEvent, params))
+def _decode_msg(msg):
+    topic = msg.topic.decode('utf-8') if isinstance(msg.topic, bytes) else msg.topic
+    payload = msg.payload.decode('utf-8') if isinstance(msg.payload, bytes) else msg.payload
+    return topic, payload
+
+
+def client_message_callback(_client, _userdata, msg):
+    # logger.debug("callback for mqtt message %s %s", msg.topic, msg.payload)
+    topic, payload = _decode_msg(msg)
+    # username/feeds/feed_id , username/groups/group_id/feed_id or username/integration/words/id
+    parsed_topic = topic.split('/')
+    feed_id = parsed_topic[3] if parsed_topic[1] == 'groups' else parsed_topic[2]
+    # Event is built right here and goes straight to the main event queue
+    _notifyMqttMsgEvent(feed_id, payload)
+
+
+def client_system_message_callback(_client, _userdata, msg):
+    # logger.debug("callback for mqtt system message %s %s", msg.topic, msg.payload)
+    topic, payload = _decode_msg(msg)
+    _notifyMqttSystemMsgEvent(topic, payload)
+
+
+def _subscriptions(aio_client):
+    """ All topics owned by the aio session, in subscription order, and their consumers """
+    subscriptions = []
+    for feed_id in _state.feed_ids:
+        subscriptions.append((aio_client.feed_topic(feed_id), client_message_callback))
+    for group_id in _state.group_ids:
+        subscriptions.append((aio_client.group_topic(group_id) + '/#', client_message_callback))
+    if ADAFRUIT_IO_RANDOM_ID:
+        subscriptions.append((aio_client.randomizer_topic(ADAFRUIT_IO_RANDOM_ID),
+                              client_message_callback))
+    for topic in _state.system_topics:
+        subscriptions.append((topic, client_system_message_callback))
+    return subscriptions
+
+
+def _add_consumers(aio_client):
+    for topic, callback in _subscriptions(aio_client):
+        aio_client.message_callback_add(topic, callback)
+
+
+def _publish_rtt_callback(_client, mid, rtt):
+    logger.debug("aio publish mid %s acked in %.3f seconds", mid, rtt)
+
+
+def _reconnect_latency_callback(client, latency):
+    logger.info("aio reconnected and published after %.3f seconds tls_resumed %s",
+                latency, client.tls_resumed)
+    _notifyEventFromCallback(events.MetricEvent('aio_reconnect_latency', round(latency, 3)))
+
+
+def _report_stats():
+    global _state
+
+    if not _state.aio_client:
+        return
+    if datetime.now() - _state.stats_ts < timedelta(seconds=STATS_INTERVAL):
+        return
+    _state.stats_ts = datetime.now()
+    count, rtt_avg, rtt_max = _state.aio_client.rtt_stats()
+    logger.info("aio publishes %d rtt avg %.3f max %.3f seconds inflight %d",
+                count, rtt_avg, rtt_max, _state.aio_client.inflight)
+    if count:
+        _notifyMetricEvent('aio_publish_rtt_avg', round(rtt_avg, 3))
 
 
 def _nuke_aio_client(_state):
@@ -118,7 +243,7 @@ def _nuke_aio_client(_state):
         with stopit.ThreadingTimeout(13.90, swallow_exc=False) as timeout_ctx:
             logger.info("releasing _state.aio_client")
             _state.aio_client.disconnect()
-            _state.aio_client._client.loop_stop()
+            _state.aio_client.loop_stop()
             del _state.aio_client
     except Exception as e:
         logger.error("failed to release _state.aio_client timeout_ctx %s %s",
@@ -134,9 +259,24 @@ def _iterate_aio_client():
     if not _state.aio_rest_client:
         _state.aio_rest_client = RestClient(ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY)
 
+    if ADAFRUIT_IO_MQTT_SECURE and not _state.aio_tls_context:
+        _state.aio_tls_context = aioclient.tls_context(ADAFRUIT_IO_MQTT_CA_CERTS)
+
     if not _state.aio_client:
-        _state.aio_client = MQTTClient(ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY, secure=True)
-        _state.aio_client.on_message = client_message_callback
+        _state.aio_client = AioClient(ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY,
+                                      host=ADAFRUIT_IO_MQTT_HOST,
+                                      port=ADAFRUIT_IO_MQTT_PORT,
+                                      secure=ADAFRUIT_IO_MQTT_SECURE,
+                                      client_id=ADAFRUIT_IO_MQTT_CLIENT_ID,
+                                      qos=ADAFRUIT_IO_PUBLISH_QOS,
+                                      inflight_window=ADAFRUIT_IO_INFLIGHT_WINDOW,
+                                      clean_session=ADAFRUIT_IO_MQTT_CLEAN_SESSION,
+                                      ssl_context=_state.aio_tls_context,
+                                      protocol=ADAFRUIT_IO_MQTT_PROTOCOL,
+                                      message_expiry=ADAFRUIT_IO_MQTT_MESSAGE_EXPIRY)
+        _state.aio_client.on_publish_rtt = _publish_rtt_callback
+        _state.aio_client.on_reconnect_latency = _reconnect_latency_callback
+        _add_consumers(_state.aio_client)
         _state.aio_client_connected = False
         _state.aio_client_update_ts = datetime.now()
         _state.aio_client.connect()
@@ -161,6 +301,10 @@ def _iterate_aio_client():
     _state.aio_client_update_ts = datetime.now()
     _notifyMqttConnectEvent(const.MQTT_CONNECTED
                             if _state.aio_client_connected else const.MQTT_DISCONNECTED)
+    if _state.aio_client_connected and _state.aio_client.session_present:
+        # broker kept our subscriptions, no need to subscribe from scratch
+        logger.info("client %s resumed its session", _state.mqtt_client_id)
+        _state.lastMsgTimeStamp = datetime.now()
 
 
 def _check_subscription():
@@ -176,15 +320,9 @@ def _check_subscription():
             return
 
     # slot subscriptions down, otherwise adafruit.io will ban you
-    for feed_id in _state.feed_ids:
-        _state.aio_client.subscribe(feed_id, qos=1)
-        time.sleep(0.5)
-    for group_id in _state.group_ids:
-        _state.aio_client.subscribe_group(group_id, qos=1)
+    for topic, _callback in _subscriptions(_state.aio_client):
+        _state.aio_client.subscribe(topic, qos=1)
         time.sleep(0.5)
-    if ADAFRUIT_IO_RANDOM_ID:
-        _state.aio_client.subscribe_randomizer(ADAFRUIT_IO_RANDOM_ID)
-    # _state.aio_client.subscribe_time('iso')
     logger.info("client %s subscribed to feeds", _state.mqtt_client_id)
     # reset timer, so we do not subscribe again until next msg expiration
     _state.lastMsgTimeStamp = datetime.now()
@@ -193,6 +331,9 @@ def _check_subscription():
 # external to this module
 def do_iterate():
     global _state
+
+    if _state.callback_error:
+        raise _state.callback_error
     _iterate_aio_client()
     try:
         queue_timeout = CMDQ_GET_TIMEOUT if _state.aio_client_connected else 1
@@ -204,6 +345,7 @@ def do_iterate():
         _check_subscription()
     except (KeyboardInterrupt, SystemExit):
         pass
+    _report_stats()
 
 
 # =============================================================================
@@ -217,7 +359,9 @@ def _limited(until):
 
 
 @RateLimiter(max_calls=54, period=60, callback=_limited)
-def _publish(feed_id, value=None, group_id=None):
+def _publish(feed_id, value=None, group_id=None, reported=None):
+    # reported, when not None, goes back to main in an AioForwardedEvent once
+    # the publish is handed to a connected client
     global _state
     if not _state.aio_client:
         logger.warning("no client to publish mqtt feed %s %s %s", feed_id, value, group_id)
@@ -226,14 +370,19 @@ def _publish(feed_id, value=None, group_id=None):
         logger.warning("not connected client to publish feed %s %s %s", feed_id, value, group_id)
         return
     try:
-        with stopit.ThreadingTimeout(9.90, swallow_exc=False) as timeout_ctx:
-            # logger.debug("publishing mqtt topic %s %s", topic, newState)
-            _state.aio_client.publish(feed_id, value, group_id)
+        # Note: does not wait for the ack. Up to inflight window publishes are pipelined
+        info = _state.aio_client.publish(feed_id, value, group_id)
     except Exception as e:
-        logger.error("failed aio_client publish feed %s %s %s timeout_ctx %s %s",
-                     feed_id, value, group_id, timeout_ctx, e)
+        logger.error("failed aio_client publish feed %s %s %s %s",
+                     feed_id, value, group_id, e)
+        return
+    if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        logger.error("failed aio_client publish feed %s %s %s rc %s %s",
+                     feed_id, value, group_id, info.rc, mqtt.error_string(info.rc))
         return
-    logger.debug("published aio_client feed %s %s %s", feed_id, value, group_id)
+    logger.debug("published aio_client feed %s %s %s mid %s", feed_id, value, group_id, info.mid)
+    if reported is not None:
+        _notifyEvent(events.AioForwardedEvent(group_id, feed_id, reported))
 
 
 # =============================================================================
@@ -250,44 +399,67 @@ def _enqueue_cmd(l_dill_raw):
     return True
 
 
-# external to this module
-def publish(feed_id, payload, group_id):
+# external to this module. report asks for an AioForwardedEvent once published
+def publish(feed_id, payload, group_id, report=False):
     translate_payload = {"on": 1, "off": 0}
     payload2 = translate_payload.get(payload, payload)
-    params = [feed_id, payload2, group_id]
+    params = [feed_id, payload2, group_id, payload if report else None]
     return _enqueue_cmd((_publish, params))
 
 
 # =============================================================================
 
 
-def _get_local_time():
+def _fetch_aio_time_sample():
+    if ADAFRUIT_IO_TIME_SOURCE == "system":
+        return localclock.system_time_sample()
     api_url = TIME_SERVICE % (
         ADAFRUIT_IO_USERNAME, ADAFRUIT_IO_KEY, ADAFRUIT_IO_TIMEZONE)
     api_url += TIME_SERVICE_STRFTIME
     try:
+        start = time.monotonic()
         response = requests.get(api_url, timeout=10)
+        rtt = time.monotonic() - start
     except Exception as e:
         logger.error(f"Failed get local time: {e}")
-        return
+        return None
     if response.status_code != 200:
         logger.error(f"Unable get local time: {response.status_code}")
-        return
+        return None
     logger.debug(f"Local time reply: {response.text}")
-    times = response.text.split(" ")
-    the_date = times[0]
-    the_time = times[1]
-    year_day = int(times[2])
-    week_day = int(times[3])
-    is_dst = None  # no way to know yet
-    year, month, mday = [int(x) for x in the_date.split("-")]
-    the_time = the_time.split(".")[0]
-    hours, minutes, seconds = [int(x) for x in the_time.split(":")]
-    now = time.struct_time(
-        (year, month, mday, hours, minutes, seconds, week_day, year_day, is_dst)
-    )
-    _notifyEvent(events.LocalTimeEvent(response.text, now))
-    response.close()
+    try:
+        sample = localclock.parse_aio_strftime(response.text)
+    except (ValueError, IndexError) as e:
+        logger.error(f"Unable to parse local time {response.text}: {e}")
+        return None
+    finally:
+        response.close()
+    # reply was produced somewhere within the round trip
+    return sample._replace(utc=sample.utc + rtt / 2, uncertainty=rtt / 2 + 0.001)
+
+
+def _sync_local_clock():
+    global _state
+
+    sample = _fetch_aio_time_sample()
+    if not sample:
+        if _state.local_clock.is_synced:
+            # keep using the model we have, with its growing error
+            return
+        logger.warning("Using system clock as fallback for local time")
+        sample = localclock.system_time_sample()
+    _state.local_clock.sync(sample)
+    logger.info("local clock synced: drift %.2f ppm uncertainty %.3f seconds",
+                _state.local_clock.drift * 1e6, _state.local_clock.uncertainty)
+
+
+def _get_local_time():
+    global _state
+
+    if _state.local_clock.needs_sync():
+        _sync_local_clock()
+    text, now = _state.local_clock.now()
+    _notifyEvent(events.LocalTimeEvent(text, now))
 
 
 # external to this module
@@ -3,34 +3,84 @@ import datetime
 import multiprocessing
 import signal
 import sys
+import threading
 import time
 
 import dill
 from os import environ as env
 import paho.mqtt.client as mqtt
 from six.moves import queue
-import stopit
 
 from ada import const
 from ada import events
 from ada import log
+from ada import mqttv5
+from ada.backoff import Backoff
 
 
 CMDQ_SIZE = 100
 CMDQ_GET_TIMEOUT = 66  # seconds. May affect ping publishing
 TOPIC_QOS = 1
+INFLIGHT_WINDOW = 100  # publishes written to client, pending on_publish
+PUBLISH_TIMEOUT = 9.90  # seconds
+RECONNECT_MIN_DELAY = 1  # seconds
+RECONNECT_MAX_DELAY = 60  # seconds
+WARMUP_TIMEOUT = 0  # seconds. Zero disables warm up from retained messages
 _state = None
 
 
+class PublishBatch(object):
+    """ Completion status of publishes requested together via do_mqtt_publish_many """
+
+    def __init__(self, size):
+        self.size = size
+        self.pending = size
+        self.failed = []
+        self.start_ts = time.monotonic()
+        self._lock = threading.Lock()  # acks are accounted from paho's thread
+
+    def done(self, topic=None, reason=None):
+        """ Account for one publish. Returns True when the whole batch is done """
+        with self._lock:
+            if reason:
+                self.failed.append((topic, reason))
+            self.pending -= 1
+            return self.pending == 0
+
+
 class State(object):
-    def __init__(self, queueEventFun, mqtt_broker_ip, mqtt_client_id, topics):
+    def __init__(self, queueEventFun, mqtt_broker_ip, mqtt_client_id, topics,
+                 mqtt_broker_port=1883, warmup_timeout=WARMUP_TIMEOUT,
+                 protocol=mqtt.MQTTv311, message_expiry=None):
         self.queueEventFun = queueEventFun  # queue for output events
         self.cmdq = multiprocessing.Queue(CMDQ_SIZE)  # queue for input commands
         self.mqtt_broker_ip = mqtt_broker_ip
+        self.mqtt_broker_port = mqtt_broker_port
         self.mqtt_client_id = mqtt_client_id
         self.topics = topics
         self.mqtt_client = None
         self.connected = False
+        # publishes are pipelined. Completion is tracked via on_publish callbacks
+        self.inflight_cond = threading.Condition()
+        self.inflight = {}  # mid -> (topic, monotonic ts of publish, PublishBatch or None)
+        self.early_acks = set()  # mids that got on_publish before publish returned
+        self.publishing = 0  # publish() calls in progress. Only they can get early acks
+        self.publish_count = 0
+        self.dropped_disconnected = 0  # qos0 publishes dropped while not connected
+        self.callback_error = None
+        # one client for the life of the process. paho reconnects it with backoff
+        self.reconnect_backoff = Backoff(RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY)
+        self.disconnect_ts = None  # monotonic
+        self.subscribed = False  # subscribe at least once per process, even with a session
+        # Warm up: retained messages go to main flagged as such, so main can
+        # compare them with what aio holds instead of forwarding them blindly
+        self.warmup_timeout = warmup_timeout
+        self.warmup_deadline = None  # monotonic, while warm up is running
+        self.retained_count = 0  # retained messages handed to main during warm up
+        # MQTT v5 only: topic aliases for hot topics and expiry of stale publishes
+        self.protocol = protocol
+        self.message_expiry = message_expiry
+        self.topic_aliases = mqttv5.TopicAliases()
 
 
 # =============================================================================
@@ -41,33 +91,56 @@ def do_init(queueEventFun=None):
     global _state
 
     mqtt_broker_ip = env.get('MQTT_LOCAL_BROKER_IP', 'localhost')
+    mqtt_broker_port = int(env.get('MQTT_LOCAL_BROKER_PORT', '1883'))
     mqtt_client_id = const.MQTT_CLIENT_LOCAL
     topics = const.MQTT_LOCAL_TOPICS
+    warmup_timeout = float(env.get('MQTT_LOCAL_WARMUP_TIMEOUT', WARMUP_TIMEOUT))
+    protocol = mqttv5.protocol_from_env(env.get('MQTT_LOCAL_PROTOCOL'))
+    message_expiry = int(env.get('MQTT_LOCAL_MESSAGE_EXPIRY', '0')) or None
 
-    _state = State(queueEventFun, mqtt_broker_ip, mqtt_client_id, topics)
+    _state = State(queueEventFun, mqtt_broker_ip, mqtt_client_id, topics, mqtt_broker_port,
+                   warmup_timeout, protocol, message_expiry)
     # logger.debug("mqttclient init called")
     return _state.cmdq
 
 
 # =============================================================================
 
-def _notifyMqttConnectEvent(event, rc):
+def _notifyMqttConnectEvent(event, rc, reconnect_duration=None):
     global _state
     if event == const.MQTT_CONNECTED:
         logger.info("got mqtt connect event %s %s", event, rc)
         _state.connected = True
+        _restart_inflight_clock()
+        if _state.dropped_disconnected:
+            logger.warning("dropped %d qos0 mqtt publishes while disconnected",
+                           _state.dropped_disconnected)
+            _notifyEvent(events.MetricEvent('mqtt_local_dropped_disconnected',
+                                            _state.dropped_disconnected))
+            _state.dropped_disconnected = 0
     else:
-        if _state.mqtt_client:
-            logger.warning("got mqtt disconnect event %s %s . Purging client", event, rc)
-            _state.mqtt_client.loop_stop()
-            _state.mqtt_client = None
+        # Note: client is kept. Its network loop reconnects and the broker holds
+        # our session, including qos1 messages published while we are away
+        logger.warning("got mqtt disconnect event %s %s", event, rc)
+        _state.connected = False
     _notifyEvent(events.MqttConnectEvent(_state.mqtt_client_id, event, rc))
+    if reconnect_duration is not None:
+        logger.info("mqtt client reconnected after %.3f seconds", reconnect_duration)
+        _notifyEvent(events.MetricEvent('mqtt_local_reconnect_duration',
+                                        round(reconnect_duration, 3)))
+
+
+def _notifyMqttMsgEvent(topic, payload, retained=False):
+    global _state
+    logger.info("got mqtt message %s %s%s", topic, payload, " (retained)" if retained else "")
+    _notifyEventFromCallback(events.MqttMsgEvent(_state.mqtt_client_id, topic, payload,
+                                                 retained))
 
 
-def _notifyMqttMsgEvent(topic, payload):
+def _notifyMqttPublishErrorEvent(topic, reason):
     global _state
-    logger.info("got mqtt message %s %s", topic, payload)
-    _notifyEvent(events.MqttMsgEvent(_state.mqtt_client_id, topic, payload))
+    logger.error("client failed publish mqtt topic %s: %s", topic, reason)
+    _notifyEvent(events.MqttPublishErrorEvent(_state.mqtt_client_id, topic, reason))
 
 
 def _notifyEvent(event):
@@ -76,46 +149,155 @@ def _notifyEvent(event):
         _state.queueEventFun(event)
 
 
+def _notifyEventFromCallback(event):
+    # Runs in paho's thread. A failure here must still stop this process, so it is
+    # raised again from do_iterate, woken up for it
+    global _state
+    try:
+        _notifyEvent(event)
+    except RuntimeError as e:
+        logger.error("unable to notify event from callback: %s", e)
+        _state.callback_error = e
+        _enqueue_cmd((_raise_callback_error, []))
+
+
+def _raise_callback_error():
+    raise _state.callback_error
+
+
 # =============================================================================
 
 
-def client_connect_callback(client, userdata, flags_dict, rc):
+def _set_reconnect_delay(client):
+    # paho doubles its delay without jitter, so feed it one jittered value at a time
+    global _state
+    delay = _state.reconnect_backoff.next_delay()
+    client.reconnect_delay_set(min_delay=delay, max_delay=delay)
+
+
+def client_connect_callback(client, userdata, flags_dict, rc, properties=None):
     global _state
+    # aliases belong to a connection. Server tells how many it takes in its CONNACK
+    _state.topic_aliases.reset(mqttv5.topic_alias_maximum(properties))
     if rc != mqtt.MQTT_ERR_SUCCESS:
         logger.warning("client %s connect failed with flags %s rc %s %s",
                        _state.mqtt_client_id, flags_dict, rc, mqtt.error_string(rc))
+        _set_reconnect_delay(client)
         return
     logger.info("client %s connected with flags %s rc %s", _state.mqtt_client_id, flags_dict, rc)
+    _state.reconnect_backoff.reset()
+    _set_reconnect_delay(client)
+    with _state.inflight_cond:
+        _state.early_acks.clear()
     # userdata is list of topics we care about
     assert isinstance(userdata, list), "Unexpected userdata from callback: {}".format(userdata)
     assert userdata[0] == 'topics', "Unexpected userdata from callback: {}".format(userdata)
     mqtt2cmd_topics = [(t, TOPIC_QOS) for t in userdata[1:]]
-    if mqtt2cmd_topics:
+    # A present session still has our subscriptions. No need for a subscribe storm.
+    # First connection of this process always subscribes: topics may have changed
+    # and that is what makes the broker hand over its retained messages.
+    if mqtt2cmd_topics and not (_state.subscribed and flags_dict.get('session present')):
+        if _state.warmup_timeout and not _state.subscribed:
+            _state.warmup_deadline = time.monotonic() + _state.warmup_timeout
+            logger.info("warming up from retained messages for %s seconds",
+                        _state.warmup_timeout)
         client.subscribe(mqtt2cmd_topics)
-    _enqueue_cmd((_notifyMqttConnectEvent, [const.MQTT_CONNECTED, rc]))
+        _state.subscribed = True
+    reconnect_duration = None
+    if _state.disconnect_ts is not None:
+        reconnect_duration = time.monotonic() - _state.disconnect_ts
+        _state.disconnect_ts = None
+    _enqueue_cmd((_notifyMqttConnectEvent, [const.MQTT_CONNECTED, rc, reconnect_duration]))
+
+
+def client_connect_fail_callback(client, _userdata):
+    _set_reconnect_delay(client)
 
 
-def client_disconnect_callback(_client, _userdata, rc):
+def client_disconnect_callback(client, _userdata, rc, _properties=None):
+    global _state
+    _state.topic_aliases.reset()
+    if _state.disconnect_ts is None:
+        _state.disconnect_ts = time.monotonic()
+    _set_reconnect_delay(client)
     _enqueue_cmd((_notifyMqttConnectEvent, [const.MQTT_DISCONNECTED, rc]))
 
 
 def client_message_callback(_client, _userdata, msg):
+    # Event is built right here and goes straight to the main event queue
     logger.debug("callback for mqtt message %s %s", msg.topic, msg.payload)
     topic = msg.topic.decode('utf-8') if isinstance(msg.topic, bytes) else msg.topic
     payload = msg.payload.decode('utf-8') if isinstance(msg.payload, bytes) else msg.payload
-    params = [topic, payload]
-    _enqueue_cmd((_notifyMqttMsgEvent, params))
+    _notifyMqttMsgEvent(topic, payload, _is_retained(msg.retain))
+
+
+def use_warmup():
+    return float(env.get('MQTT_LOCAL_WARMUP_TIMEOUT', WARMUP_TIMEOUT)) > 0
+
+
+def _is_warming_up():
+    global _state
+    deadline = _state.warmup_deadline
+    return deadline is not None and time.monotonic() < deadline
+
+
+def _is_retained(retained):
+    """ Only flag retained messages when warm up is enabled. Main then forwards
+        them to aio only if they differ from the last value aio got.
+    """
+    global _state
+    if not (retained and _state.warmup_timeout):
+        return False
+    if _is_warming_up():
+        _state.retained_count += 1
+    return True
+
 
+def _check_warmup():
+    global _state
+    if _state.warmup_deadline is None or _is_warming_up():
+        return
+    _state.warmup_deadline = None
+    logger.info("warm up done: %d retained messages handed over for comparison with aio",
+                _state.retained_count)
+    _notifyEvent(events.MetricEvent('mqtt_local_warmup_retained', _state.retained_count))
 
-def _setup_mqtt_client(broker_ip, client_id, topics):
+
+def client_publish_callback(_client, _userdata, mid):
+    # Note: paho holds its message lock while calling this. Never publish from here.
+    global _state
+    with _state.inflight_cond:
+        entry = _state.inflight.pop(mid, None)
+        if entry is None and _state.publishing:
+            # else an ack for an expired mid, which a later publish may reuse
+            _state.early_acks.add(mid)
+        _state.inflight_cond.notify_all()
+    if entry and entry[2] and entry[2].done():
+        _batch_completed(entry[2])
+
+
+def _setup_mqtt_client(broker_ip, client_id, topics, broker_port=1883,
+                       protocol=mqtt.MQTTv311):
     try:
         userdata = ['topics'] + topics
-        client = mqtt.Client(client_id=client_id, userdata=userdata)
+        # client_id is stable, so the broker can keep a persistent session for us
+        if protocol == mqtt.MQTTv5:
+            client = mqtt.Client(client_id=client_id, userdata=userdata, protocol=protocol)
+        else:
+            client = mqtt.Client(client_id=client_id, clean_session=False, userdata=userdata)
+        _set_reconnect_delay(client)
         client.on_connect = client_connect_callback
+        client.on_connect_fail = client_connect_fail_callback
         client.on_disconnect = client_disconnect_callback
         client.on_message = client_message_callback
-
-        client.connect_async(broker_ip, port=1883, keepalive=179)
+        client.on_publish = client_publish_callback
+        client.max_inflight_messages_set(INFLIGHT_WINDOW)
+
+        if protocol == mqtt.MQTTv5:
+            client.connect_async(broker_ip, port=broker_port, keepalive=179, clean_start=False,
+                                 properties=mqttv5.connect_properties())
+        else:
+            client.connect_async(broker_ip, port=broker_port, keepalive=179)
         logger.info("setting up mqtt client to broker %s", broker_ip)
         return client
     except Exception as e:
@@ -130,9 +312,13 @@ def _setup_mqtt_client(broker_ip, client_id, topics):
 def do_iterate():
     global _state
 
+    if _state.callback_error:
+        raise _state.callback_error
+
     if not _state.mqtt_client:
         _state.mqtt_client = _setup_mqtt_client(_state.mqtt_broker_ip, _state.mqtt_client_id,
-                                                _state.topics)
+                                                _state.topics, _state.mqtt_broker_port,
+                                                _state.protocol)
         if not _state.mqtt_client:
             logger.warning("got no mqttt client")
             time.sleep(30)
@@ -141,7 +327,8 @@ def do_iterate():
         _state.mqtt_client.loop_start()
 
     try:
-        cmdDill = _state.cmdq.get(True, CMDQ_GET_TIMEOUT)
+        queue_timeout = 1 if _state.warmup_deadline else CMDQ_GET_TIMEOUT
+        cmdDill = _state.cmdq.get(True, queue_timeout)
         cmdFun, params = dill.loads(cmdDill)
         cmdFun(*params)
         logger.debug("executed a lambda command with params %s", params)
@@ -150,26 +337,131 @@ def do_iterate():
         pass
     except (KeyboardInterrupt, SystemExit):
         pass
+    _expire_inflight()
+    _check_warmup()
 
 
 # =============================================================================
 
 
-def _mqtt_publish(topic, payload=None, qos=0, retain=False, properties=None):
+def _batch_completed(batch):
+    elapsed = time.monotonic() - batch.start_ts
+    if not batch.failed:
+        logger.debug("published batch of %d mqtt topics in %.3f seconds", batch.size, elapsed)
+        return
+    topic, reason = batch.failed[0]
+    _notifyMqttPublishErrorEvent(topic, "{} ({} of {} publishes in batch)".format(
+        reason, len(batch.failed), batch.size))
+
+
+def _drop_inflight(entries, reason):
+    # one report for the loose publishes and one per batch, so an outage
+    # does not flood the event queue
+    loose = [topic for topic, _ts, batch in entries if not batch]
+    if loose:
+        _notifyMqttPublishErrorEvent(loose[0], "{} ({} publishes)".format(reason, len(loose)))
+    for topic, _ts, batch in entries:
+        if batch and batch.done(topic, reason):
+            _batch_completed(batch)
+
+
+def _restart_inflight_clock():
+    # paho sends pending publishes again on reconnect. Their timeout starts over
+    global _state
+    now = time.monotonic()
+    with _state.inflight_cond:
+        for mid, (topic, _ts, batch) in list(_state.inflight.items()):
+            _state.inflight[mid] = (topic, now, batch)
+
+
+def _expire_inflight():
+    global _state
+    if not _state.connected:
+        # clock is stopped while disconnected: paho holds them for the next connection
+        return
+    expired = []
+    now = time.monotonic()
+    with _state.inflight_cond:
+        for mid, entry in list(_state.inflight.items()):
+            if now - entry[1] >= PUBLISH_TIMEOUT:
+                del _state.inflight[mid]
+                expired.append(entry)
+    _drop_inflight(expired, "timeout")
+
+
+def _wait_inflight_window():
+    global _state
+    if not _state.connected:
+        return  # no acks to wait for until reconnect. paho queues them meanwhile
+    with _state.inflight_cond:
+        if _state.inflight_cond.wait_for(lambda: len(_state.inflight) < INFLIGHT_WINDOW,
+                                         PUBLISH_TIMEOUT):
+            return
+    _expire_inflight()
+
+
+def _mqtt_publish(topic, payload=None, qos=0, retain=False, properties=None, batch=None):
     global _state
     if not _state.mqtt_client:
+        reason = "no client"
         logger.warning("no client to publish mqtt topic %s %s", topic, payload)
-        return
+        if batch and batch.done(topic, reason):
+            _batch_completed(batch)
+        return None
+    if qos == 0 and not _state.connected:
+        # nothing would resend it. Counted and reported on reconnect, not one event each
+        _state.dropped_disconnected += 1
+        logger.debug("not connected: dropped mqtt topic %s %s", topic, payload)
+        if batch and batch.done():
+            _batch_completed(batch)
+        return None
+    _wait_inflight_window()
+    wire_topic = topic
+    if _state.protocol == mqtt.MQTTv5:
+        # qos0 only: a publish that is sent again on a new connection cannot use an alias
+        use_alias = qos == 0 and _state.connected
+        wire_topic, properties = _state.topic_aliases.publish_args(
+            topic, _state.message_expiry, properties, use_alias)
+    info, reason, acked = None, "not published", False
+    with _state.inflight_cond:
+        _state.publishing += 1
     try:
-        with stopit.ThreadingTimeout(9.90, swallow_exc=False) as timeout_ctx:
-            # logger.debug("publishing mqtt topic %s %s", topic, newState)
-            info = _state.mqtt_client.publish(topic, payload, qos, retain, properties)
-            info.wait_for_publish()
+        info = _state.mqtt_client.publish(wire_topic, payload, qos, retain, properties)
+        # qos1 without a connection is queued by paho, and sent once it reconnects
+        queued = qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN
+        reason = None if info.rc == mqtt.MQTT_ERR_SUCCESS or queued else \
+            mqtt.error_string(info.rc)
     except Exception as e:
-        logger.error("client failed publish mqtt topic %s %s timeout_ctx %s %s", topic, payload,
-                     timeout_ctx, e)
+        reason = str(e) or e.__class__.__name__
+    finally:
+        with _state.inflight_cond:
+            _state.publishing -= 1
+            if not reason:
+                acked = info.mid in _state.early_acks
+                if not acked:
+                    _state.inflight[info.mid] = (topic, time.monotonic(), batch)
+            if not _state.publishing:
+                _state.early_acks.clear()
+    if reason:
+        if not batch:
+            _notifyMqttPublishErrorEvent(topic, reason)
+        elif batch.done(topic, reason):
+            _batch_completed(batch)
+        return None
+    _state.publish_count += 1
+    if acked and batch and batch.done():
+        _batch_completed(batch)
+    logger.debug("published mqtt topic %s %s mid %s", topic, payload, info.mid)
+    return info.mid
+
+
+def _mqtt_publish_many(entries):
+    """ Fan out a batch of (topic, payload, qos, retain) publishes, pipelined """
+    if not entries:
         return
-    logger.debug("published mqtt topic %s %s", topic, payload)
+    batch = PublishBatch(len(entries))
+    for topic, payload, qos, retain in entries:
+        _mqtt_publish(topic, payload, qos, retain, batch=batch)
 
 
 # =============================================================================
@@ -191,6 +483,19 @@ def do_mqtt_publish(topic, payload=None, qos=0, retain=False, properties=None):
     params = [topic, payload, qos, retain, properties]
     return _enqueue_cmd((_mqtt_publish, params))
 
+
+# external to this module
+def do_mqtt_publish_many(entries, qos=0, retain=False):
+    """ Publish a batch as a single command.
+
+        entries is an iterable of (topic, payload[, qos[, retain]]) tuples. Missing
+        qos and retain are taken from the parameters.
+    """
+    defaults = (None, None, qos, retain)
+    batch = [tuple(entry) + defaults[len(entry):] for entry in entries]
+    params = [batch]
+    return _enqueue_cmd((_mqtt_publish_many, params))
+
 # =============================================================================
 
 
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+import threading
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+SESSION_EXPIRY = 86400  # seconds. Broker keeps our session this long while we are away
+HOT_TOPIC_PUBLISHES = 2  # topic gets an alias on its second publish
+
+
+def protocol_from_env(value):
+    return mqtt.MQTTv5 if str(value) == '5' else mqtt.MQTTv311
+
+
+def connect_properties(session_expiry=SESSION_EXPIRY):
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = session_expiry
+    return properties
+
+
+def topic_alias_maximum(properties):
+    """ How many aliases the server accepts from us, as told in its CONNACK """
+    return getattr(properties, 'TopicAliasMaximum', 0) if properties else 0
+
+
+class TopicAliases(object):
+    """ Client side topic aliases for MQTT v5 publishes.
+
+        Aliases are only valid for the current connection, so reset() must be
+        called on every connect with the maximum the server allows. A topic gets
+        an alias once it is hot. The publish that creates the alias carries the
+        full topic; later ones carry an empty topic and just the alias.
+    """
+
+    def __init__(self, hot_publishes=HOT_TOPIC_PUBLISHES):
+        self.hot_publishes = hot_publishes
+        self.maximum = 0
+        self.aliases = {}  # topic -> alias
+        self.counts = {}  # topic -> publishes, until aliased
+        self._lock = threading.Lock()
+
+    def reset(self, maximum=0):
+        with self._lock:
+            self.maximum = maximum
+            self.aliases = {}
+            self.counts = {}
+
+    def publish_args(self, topic, expiry=None, properties=None, use_alias=True):
+        """ Return topic and properties to hand over to paho's publish """
+        use_alias = use_alias and self.maximum
+        if properties is None and (expiry or use_alias):
+            properties = Properties(PacketTypes.PUBLISH)
+        if expiry:
+            properties.MessageExpiryInterval = expiry
+        if not use_alias:
+            return topic, properties
+        with self._lock:
+            alias = self.aliases.get(topic)
+            if alias:
+                properties.TopicAlias = alias
+                return "", properties
+            count = self.counts.get(topic, 0) + 1
+            if count >= self.hot_publishes and len(self.aliases) < self.maximum:
+                self.counts.pop(topic, None)
+                alias = self.aliases[topic] = len(self.aliases) + 1
+                properties.TopicAlias = alias
+            else:
+                self.counts[topic] = count
+        return topic, properties
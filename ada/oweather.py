@@ -2,6 +2,7 @@
 import multiprocessing
 import signal
 import sys
+import time
 
 from datetime import datetime, timedelta
 import dill
@@ -16,17 +17,73 @@ from os import environ as env
 
 CMDQ_SIZE = 100
 CMDQ_GET_TIMEOUT = 3606  # seconds.
+# OpenWeather recalculates current weather about this often. A response is
+# fresh until its dt plus this, and served from cache until then
+UPDATE_INTERVAL = int(env.get('OPENWEATHER_UPDATE_INTERVAL', '600'))
+MIN_REFETCH = 60  # seconds. Cached for at least this long, even when dt lags behind
+URL = env.get('OPENWEATHER_URL', 'http://api.openweathermap.org/data/2.5/')
+GROUP_SIZE = 20  # most city ids the group endpoint takes in one request
+REQUEST_TIMEOUT = 18.90  # seconds
+TOPIC_PREFIX = '/openweather'  # first location. Others publish under /openweather/<location>
 _state = None
 
 
+class Location(object):
+    def __init__(self, city_id, name, primary):
+        self.city_id = city_id
+        self.name = name
+        self.prefix = TOPIC_PREFIX if primary else f"{TOPIC_PREFIX}/{name}"
+
+    def __repr__(self):
+        return f"{self.name}({self.city_id})"
+
+
+def parse_locations(city_ids):
+    """ Locations from a comma separated list of city ids, each optionally
+        followed by :name for its topics. The name defaults to the city id.
+        Names that are not a single topic level are left out.
+    """
+    locations = []
+    for entry in (city_ids or '').split(','):
+        city_id, _, name = entry.strip().partition(':')
+        if not city_id:
+            continue
+        name = name or city_id
+        if any(c in name for c in '/+#'):
+            logger.error("openweather location %s has a name %r with / + or #. Left out",
+                         city_id, name)
+            continue
+        locations.append(Location(city_id, name, primary=not locations))
+    return locations
+
+
+class CachedWeather(object):
+    def __init__(self, payload, etag):
+        self.payload = payload
+        self.etag = etag
+        self.fetched_ts = time.time()
+
+    def fresh(self, now):
+        dt = self.payload.get('dt', 0) if isinstance(self.payload, dict) else 0
+        return now < max(dt + UPDATE_INTERVAL, self.fetched_ts + MIN_REFETCH)
+
+
 class State(object):
     def __init__(self, queueEventFun):
         self.queueEventFun = queueEventFun  # queue for output events
         self.cmdq = multiprocessing.Queue(CMDQ_SIZE)  # queue for input commands
+        # set while a fetch is queued. Set and cleared across processes
+        self.fetch_pending = multiprocessing.Event()
         self.openweather_api = env.get('OPENWEATHER_API')
         self.openweather_city_id = env.get('OPENWEATHER_CITY_ID')
+        self.locations = parse_locations(self.openweather_city_id)
+        self.use_group = True  # until the group endpoint turns out unavailable
         self.openweather_fetch_interval = int(env.get('OPENWEATHER_INTERVAL', CMDQ_GET_TIMEOUT))
         self.last_fetch_ts = datetime.now()
+        self.session = None  # keep-alive, made in the openweather process
+        self.cache = {}  # city id -> CachedWeather
+        self.calls = 0
+        self.calls_saved = 0
 
 
 # =============================================================================
@@ -43,11 +100,17 @@ def do_init(queueEventFun=None):
 
 # =============================================================================
 
-def _notifyOpenweatherEvent(payload):
+def _notifyOpenweatherEvent(location, payload):
+    global _state
+    logger.info("got openweather message for %s %s", location, payload)
+    if _state.queueEventFun:
+        _state.queueEventFun(events.OpenWeatherEvent(payload, location.prefix))
+
+
+def _notifyMetricEvent(name, value):
     global _state
-    logger.info("got openweather message %s", payload)
     if _state.queueEventFun:
-        _state.queueEventFun(events.OpenWeatherEvent(payload))
+        _state.queueEventFun(events.MetricEvent(name, value))
 
 
 # =============================================================================
@@ -76,27 +139,113 @@ def do_iterate():
 # =============================================================================
 
 
+def _get(endpoint, params, etag=None):
+    """ Returns the response, or None if it is a 304 for etag """
+    global _state
+    if not _state.session:
+        _state.session = requests.Session()
+    headers = {'If-None-Match': etag} if etag else {}
+    params = dict(params, appid=_state.openweather_api, units='imperial')
+    _state.calls += 1
+    with stopit.ThreadingTimeout(REQUEST_TIMEOUT, swallow_exc=False):
+        res = _state.session.get(URL + endpoint, params=params, headers=headers, timeout=15)
+    if res.status_code == 304 and etag:
+        return None
+    res.raise_for_status()
+    return res
+
+
+def _describe(e):
+    # request errors can carry the url, api key included
+    text = str(e)
+    return text.replace(_state.openweather_api, '***') if _state.openweather_api else text
+
+
+def _fetch_weather(city_id):
+    global _state
+    cached = _state.cache.get(city_id)
+    res = _get('weather', {'id': city_id}, cached.etag if cached else None)
+    if res is None:
+        cached.fetched_ts = time.time()
+        return
+    _state.cache[city_id] = CachedWeather(res.json(), res.headers.get('ETag'))
+
+
+def _fetch_group(city_ids):
+    """ Many cities in one request per GROUP_SIZE of them. Entries are the same
+        as from the weather endpoint. A batch that fails does not stop the
+        others. Returns the city ids of failed batches.
+    """
+    global _state
+    failed = []
+    for i in range(0, len(city_ids), GROUP_SIZE):
+        batch = city_ids[i:i + GROUP_SIZE]
+        try:
+            res = _get('group', {'id': ','.join(batch)})
+            for payload in res.json().get('list', []):
+                _state.cache[str(payload.get('id'))] = CachedWeather(payload, None)
+        except requests.HTTPError as e:
+            if e.response.status_code in (400, 404):
+                raise
+            logger.error("failed to get openweather group of %d cities: %s", len(batch),
+                         e.response.status_code)
+            failed.extend(batch)
+        except Exception as e:
+            logger.error("failed to get openweather group of %d cities: %s", len(batch),
+                         _describe(e))
+            failed.extend(batch)
+    return failed
+
+
+def _fetch_stale(city_ids):
+    """ Returns the city ids that failed """
+    global _state
+    if len(city_ids) > 1 and _state.use_group:
+        try:
+            return _fetch_group(city_ids)
+        except requests.HTTPError as e:
+            logger.warning("openweather group endpoint unavailable (%s), fetching cities "
+                           "one by one", e.response.status_code)
+            _state.use_group = False
+    failed = []
+    for city_id in city_ids:
+        try:
+            _fetch_weather(city_id)
+        except Exception as e:
+            logger.error("failed to get openweather for city %s %s", city_id, _describe(e))
+            failed.append(city_id)
+    return failed
+
+
 def _fetch():
     global _state
 
-    data = {'api': _state.openweather_api,
-            'city_id': _state.openweather_city_id}
-    if not all(data.values()):
-        logger.info("not enough data for openweather api %s", data)
-        return
-    url = 'http://api.openweathermap.org/data/2.5/weather?id={}&appid={}&units=imperial'.format(
-        data['city_id'], data['api'])
-    payload = ''
-    try:
-        with stopit.ThreadingTimeout(18.90, swallow_exc=False) as timeout_ctx:
-            res = requests.get(url, timeout=15)
-            payload = res.json()
-    except Exception as e:
-        logger.error("failed to get url %s %s timeout_ctx %s %s", url, payload,
-                     timeout_ctx, e)
+    # requests queued while this one was waiting are served by it
+    _state.fetch_pending.clear()
+    if not _state.openweather_api or not _state.locations:
+        logger.info("not enough data for openweather api %s %s", _state.openweather_api,
+                    _state.locations)
         return
-    _notifyOpenweatherEvent(payload)
-    _state.last_fetch_ts = datetime.now()
+    now = time.time()
+    stale = [location.city_id for location in _state.locations
+             if not (location.city_id in _state.cache and
+                     _state.cache[location.city_id].fresh(now))]
+    _state.calls_saved += len(_state.locations) - len(stale)
+    failed = _fetch_stale(stale) if stale else []
+    if failed:
+        # start over with a new connection
+        _state.session = None
+    # locations that failed still get what is cached for them
+    for location in _state.locations:
+        cached = _state.cache.get(location.city_id)
+        if not cached:
+            logger.warning("no openweather for %s", location)
+            continue
+        _notifyOpenweatherEvent(location, cached.payload)
+    _notifyMetricEvent('openweather_calls', _state.calls)
+    _notifyMetricEvent('openweather_calls_saved', _state.calls_saved)
+    if not failed:
+        _state.last_fetch_ts = datetime.now()
 
 
 # =============================================================================
@@ -115,8 +264,17 @@ def _enqueue_cmd(l_dill_raw):
 
 # external to this module
 def do_fetch():
+    global _state
+    # Reconnect storms ask for many fetches. One queued fetch serves them all
+    if _state.fetch_pending.is_set():
+        logger.debug("openweather fetch already queued")
+        return True
+    _state.fetch_pending.set()
     params = []
-    return _enqueue_cmd((_fetch, params))
+    if not _enqueue_cmd((_fetch, params)):
+        _state.fetch_pending.clear()
+        return False
+    return True
 
 # =============================================================================
 
@@ -1,18 +1,40 @@
 import json
+import os
 import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from time import time
+from os import environ as env
+from os import path
+from time import monotonic, time
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ReadTimeout
 from websocket import create_connection
-from websocket._exceptions import WebSocketTimeoutException
+from websocket._exceptions import WebSocketBadStatusException, WebSocketTimeoutException
 
-API_URL = 'https://api.sense.com/apiservice/api/v1/'
-WS_URL = "wss://clientrt.sense.com/monitors/%s/realtimefeed?access_token=%s"
+from ada import log
+from ada.backoff import Backoff
+
+API_URL = env.get('SENSE_API_URL', 'https://api.sense.com/apiservice/api/v1/')
+WS_URL = env.get('SENSE_WS_URL', "wss://clientrt.sense.com/monitors/%s/realtimefeed?access_token=%s")
 API_TIMEOUT = 10
 WSS_TIMEOUT = 10
 RATE_LIMIT = 180
+AUTH_CACHE = env.get('SENSE_AUTH_CACHE', path.expanduser('~/.cache/adaio/sense_auth.json'))
+AUTH_FAILED = (401, 403)
+REALTIME_INTERVAL = 1.0  # seconds. Stream keeps at most one realtime update per interval
+REALTIME_MAX_AGE = 60  # seconds. An older snapshot from the stream is stale
+RECONNECT_MIN = 1  # seconds
+RECONNECT_MAX = 120  # seconds
+# seconds for a trend update, shared by all its scales and monitors. The pool
+# has a worker per scale and monitor, so they all start at once and each scale
+# gets the whole deadline to itself, unless a re-authentication delays it
+TREND_DEADLINE = 20
+# seconds a trend scale is kept before fetched again. All but HOUR are also
+# fetched again when the day rolls over, since trends start at midnight
+TREND_MAX_AGE = {'HOUR': 0, 'DAY': 1800, 'WEEK': 3600, 'MONTH': 3600, 'YEAR': 3600}
 
 # for the last hour, day, week, month, or year
 VALID_SCALES = ['HOUR', 'DAY', 'WEEK', 'MONTH', 'YEAR']
@@ -22,36 +44,179 @@ class SenseAPITimeoutException(Exception):
     pass
 
 
+class SenseAPIException(Exception):
+    pass
+
+
 class SenseAuthenticationException(Exception):
     pass
 
 
-class SenseApi(object):
+class AuthCache(object):
+    """ Sense access token, user id and monitors kept on disk across restarts.
 
-    def __init__(self, username=None, password=None,
-                 api_timeout=API_TIMEOUT, wss_timeout=WSS_TIMEOUT):
+        File is only readable by its owner and replaced atomically. Entry is only
+        used for the username that saved it.
+    """
 
-        # Timeout instance variables
-        self.api_timeout = api_timeout
-        self.wss_timeout = wss_timeout
-        self.rate_limit = RATE_LIMIT
+    def __init__(self, filename=AUTH_CACHE):
+        self.filename = filename
+
+    def load(self, username):
+        try:
+            if os.stat(self.filename).st_mode & 0o077:
+                logger.warning("ignoring sense auth cache %s: readable by others", self.filename)
+                return None
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('username') != username:
+            return None
+        return data
+
+    def save(self, username, data):
+        entry = {'username': username,
+                 'access_token': data['access_token'],
+                 'user_id': data['user_id'],
+                 'monitors': [{'id': monitor['id']} for monitor in data['monitors']]}
+        tmp_filename = self.filename + '.tmp'
+        try:
+            os.makedirs(path.dirname(self.filename), mode=0o700, exist_ok=True)
+            fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.filename)
+        except OSError as e:
+            logger.warning("unable to save sense auth cache %s: %s", self.filename, e)
+
+
+class RealtimeStream(object):
+    """ Keeps one realtime websocket open in a background thread.
+
+        Reconnects with backoff when the socket fails or goes quiet. Updates that
+        arrive sooner than interval after the last kept one are dropped without
+        being parsed. The latest kept update is available as snapshot.
+        url_fun returns the url to connect to. auth_failed is called with the url
+        the server rejected with 401/403. on_update is called from the stream
+        thread with each kept update. Its errors are logged and counted; they
+        do not reconnect the stream.
+    """
+
+    def __init__(self, url_fun, timeout=WSS_TIMEOUT, interval=REALTIME_INTERVAL,
+                 auth_failed=None, on_update=None):
+        self.url_fun = url_fun
+        self.auth_failed = auth_failed
+        self.on_update = on_update
+        self.timeout = timeout
+        self.interval = interval
+        self.snapshot = {}
+        self.snapshot_ts = None  # monotonic
+        self.updates = 0
+        self.decimated = 0
+        self.reconnects = 0
+        self.update_errors = 0
+        self._backoff = Backoff(RECONNECT_MIN, RECONNECT_MAX)
+        self._stopping = threading.Event()
+        self._has_snapshot = threading.Event()
+        self._ws = None
+        self._thread = threading.Thread(target=self._run, name='sense-realtime', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        ws = self._ws
+        if ws:
+            ws.abort()
+        self._thread.join(self.timeout)
+
+    def wait_snapshot(self, timeout):
+        return self._has_snapshot.wait(timeout)
+
+    @property
+    def age(self):
+        if self.snapshot_ts is None:
+            return None
+        return monotonic() - self.snapshot_ts
+
+    def _run(self):
+        while not self._stopping.is_set():
+            url = self.url_fun()
+            try:
+                self._stream(url)
+            except Exception as e:
+                if self._stopping.is_set():
+                    break
+                if isinstance(e, WebSocketBadStatusException) and \
+                        e.status_code in AUTH_FAILED and self.auth_failed:
+                    try:
+                        self.auth_failed(url)
+                    except Exception as auth_e:
+                        e = auth_e
+                delay = self._backoff.next_delay()
+                logger.warning("sense realtime stream failed: %s. reconnecting in %.1f seconds",
+                               e, delay)
+                self._stopping.wait(delay)
+                self.reconnects += 1
+
+    def _call_on_update(self):
+        try:
+            self.on_update(self.snapshot)
+        except Exception as e:
+            self.update_errors += 1
+            logger.error("sense realtime update handler failed: %s", e)
+
+    def _stream(self, url):
+        self._ws = create_connection(url, timeout=self.timeout,
+                                     sslopt={"cert_reqs": ssl.CERT_NONE})
+        try:
+            kept_ts = None
+            while not self._stopping.is_set():
+                frame = self._ws.recv()
+                now = monotonic()
+                if kept_ts is not None and now - kept_ts < self.interval:
+                    self.decimated += 1
+                    continue
+                result = json.loads(frame)
+                if result.get('type') != 'realtime_update':
+                    continue
+                kept_ts = now
+                self.snapshot, self.snapshot_ts = result['payload'], now
+                self._has_snapshot.set()
+                self.updates += 1
+                if self.on_update:
+                    self._call_on_update()
+                self._backoff.reset()
+        finally:
+            ws, self._ws = self._ws, None
+            ws.close()
+
+
+class SenseMonitor(object):
+    """ Realtime data, trends and devices of one Sense monitor. Requests go
+        through the SenseApi that holds the session and the access token.
+    """
+
+    def __init__(self, api, monitor_id):
+        self.api = api
+        self.sense_monitor_id = monitor_id
 
         self._realtime = {}
+        self._realtime_stream = None
         self._devices = []
         self._trend_data = {}
         for scale in VALID_SCALES: self._trend_data[scale] = {}
+        self._trend_fetched = {}  # scale -> (monotonic ts, start date)
+        self.trend_max_age = dict(TREND_MAX_AGE)
+        self.trend_calls = 0
+        self.trend_calls_saved = 0
 
-        if username and password:
-            self.authenticate(username, password)
-
-    def set_auth_data(self, data):
-        self.sense_access_token = data['access_token']
-        self.sense_user_id = data['user_id']
-        self.sense_monitor_id = data['monitors'][0]['id']
-
-        # create the auth header
-        self.headers = {'Authorization': 'bearer {}'.format(
-            self.sense_access_token)}
+    def api_call(self, url, payload={}):
+        return self.api.api_call(url, payload)
 
     def _set_realtime(self, data):
         self._realtime = data
@@ -140,35 +305,45 @@ class SenseApi(object):
             return total + self.get_trend('MONTH', is_production)
         return total
 
-    def authenticate(self, username, password):
-        auth_data = {
-            "email": username,
-            "password": password
-        }
+    def _realtime_url(self):
+        return WS_URL % (self.sense_monitor_id, self.api.sense_access_token)
 
-        # Create session
-        self.s = requests.session()
+    def _realtime_auth_failed(self, url):
+        token = self.api.sense_access_token
+        if url == self._realtime_url():
+            self.api._reauthenticate(token)
 
-        # Get auth token
-        try:
-            response = self.s.post(API_URL + 'authenticate',
-                                   auth_data, timeout=self.api_timeout)
-        except Exception as e:
-            raise Exception('Connection failure: %s' % e)
+    def start_realtime_stream(self, interval=REALTIME_INTERVAL, on_update=None):
+        if self._realtime_stream:
+            return
+        self._realtime_stream = RealtimeStream(self._realtime_url, self.api.wss_timeout, interval,
+                                               self._realtime_auth_failed, on_update)
+        self._realtime_stream.start()
 
-        # check for 200 return
-        if response.status_code != 200:
-            raise SenseAuthenticationException(
-                "Please check username and password. API Return Code: %s" %
-                response.status_code)
+    def stop_realtime_stream(self):
+        if self._realtime_stream:
+            self._realtime_stream.stop()
+            self._realtime_stream = None
 
-        self.set_auth_data(response.json())
+    @property
+    def realtime_stream(self):
+        return self._realtime_stream
 
     # Update the realtime data
     def update_realtime(self):
+        stream = self._realtime_stream
+        if stream:
+            # latest snapshot kept by the stream: no network i/o here
+            stream.wait_snapshot(self.api.wss_timeout)
+            age = stream.age
+            if age is None or age > REALTIME_MAX_AGE:
+                raise SenseAPITimeoutException("API realtime stream is stale: %s" % age)
+            if stream.snapshot is not self._realtime:
+                self._set_realtime(stream.snapshot)
+            return self._realtime
         # rate limit API calls
-        if self._realtime and self.rate_limit and \
-                self.last_realtime_call + self.rate_limit > time():
+        if self._realtime and self.api.rate_limit and \
+                self.last_realtime_call + self.api.rate_limit > time():
             return self._realtime
         next(self.get_realtime_stream())
 
@@ -176,9 +351,9 @@ class SenseApi(object):
         """ Reads realtime data from websocket
             Continues until loop broken"""
         ws = None
-        url = WS_URL % (self.sense_monitor_id, self.sense_access_token)
+        url = self._realtime_url()
         try:
-            ws = create_connection(url, timeout=self.wss_timeout,
+            ws = create_connection(url, timeout=self.api.wss_timeout,
                                    sslopt={"cert_reqs": ssl.CERT_NONE})
             while True:  # hello, features, [updates,] data
                 result = json.loads(ws.recv())
@@ -198,22 +373,67 @@ class SenseApi(object):
         # epochtime = 30256871
         # t = datetime.fromtimestamp(epochtime)
         t = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.trend_calls += 1
         self._trend_data[scale] = self.api_call(
             'app/history/trends?monitor_id=%s&scale=%s&start=%s' %
             (self.sense_monitor_id, scale, t.isoformat()))
+        self._trend_fetched[scale] = (monotonic(), t.date())
 
-    def update_trend_data(self):
-        for scale in VALID_SCALES:
-            self.get_trend_data(scale)
+    def expire_trend(self, scale):
+        # fetch scale on the next update, however fresh
+        self._trend_fetched.pop(scale, None)
 
-    def api_call(self, url, payload={}):
+    def _trend_is_fresh(self, scale):
         try:
-            return self.s.get(API_URL + url,
-                              headers=self.headers,
-                              timeout=self.api_timeout,
-                              data=payload).json()
-        except ReadTimeout:
-            raise SenseAPITimeoutException("API call timed out")
+            fetched_ts, start_date = self._trend_fetched[scale]
+        except KeyError:
+            return False
+        if scale != 'HOUR' and start_date != datetime.now().date():
+            return False
+        return monotonic() - fetched_ts < self.trend_max_age.get(scale, 0)
+
+    def submit_trend_data(self, force=False):
+        """ Start fetching the scales that are not fresh, or all of them if forced.
+            Returns dict future -> scale.
+        """
+        scales = [scale for scale in VALID_SCALES if force or not self._trend_is_fresh(scale)]
+        self.trend_calls_saved += len(VALID_SCALES) - len(scales)
+        return {self.api.trend_executor.submit(self.get_trend_data, scale): scale
+                for scale in scales}
+
+    def collect_trend_data(self, futures, deadline_ts):
+        """ Wait for submitted scales until deadline_ts (monotonic), one deadline
+            for all of them. A scale that fails or misses it keeps its previous
+            data. Returns the scales updated.
+        """
+        if not futures:
+            return []
+        done, not_done = wait(futures, timeout=max(0, deadline_ts - monotonic()))
+        updated, failed = [], {}
+        for future in done:
+            if future.exception():
+                failed[futures[future]] = future.exception()
+            else:
+                updated.append(futures[future])
+        for future in not_done:
+            failed[futures[future]] = "deadline"
+        if failed:
+            logger.warning("sense monitor %s trend scales not updated: %s",
+                           self.sense_monitor_id, failed)
+        if not updated:
+            raise SenseAPITimeoutException("API trend calls failed: %s" % failed)
+        return updated
+
+    def update_trend_data(self, deadline=TREND_DEADLINE, force=False):
+        """ Fetch trends at once for the scales that are not fresh, or for all of
+            them if forced, within deadline seconds shared by all scales.
+            Returns the scales updated.
+        """
+        futures = self.submit_trend_data(force)
+        return self.collect_trend_data(futures, monotonic() + deadline)
+
+    def close(self):
+        self.stop_realtime_stream()
 
     def get_discovered_device_names(self):
         # lots more info in here to be parsed out
@@ -241,8 +461,204 @@ class SenseApi(object):
         return self.api_call('app/monitors/%s/devices/%s' %
                              (self.sense_monitor_id, device_id))
 
+
+def _first_monitor(name):
+    # SenseApi attribute that reads the attribute of the first monitor
+    return property(lambda self: getattr(self.first_monitor, name))
+
+
+class SenseApi(object):
+    """ Session and access token of a Sense account, with one SenseMonitor per
+        monitor of the account. The realtime, trend and device attributes of a
+        single monitor are also here, taken from the first monitor, so a single
+        monitor account reads as before.
+    """
+
+    def __init__(self, username=None, password=None,
+                 api_timeout=API_TIMEOUT, wss_timeout=WSS_TIMEOUT, auth_cache=None):
+
+        # Timeout instance variables
+        self.api_timeout = api_timeout
+        self.wss_timeout = wss_timeout
+        self.rate_limit = RATE_LIMIT
+
+        self.monitors = []
+        self._trend_executor = None
+
+        self.username = username
+        self.password = password
+        self.auth_cache = auth_cache
+        self.authentications = 0
+        self._auth_lock = threading.Lock()
+        self._create_session()
+
+        if username and password:
+            cached = auth_cache.load(username) if auth_cache else None
+            if cached:
+                self.set_auth_data(cached)
+            else:
+                self.authenticate(username, password)
+            self.resize_pool()
+
+    @property
+    def first_monitor(self):
+        if not self.monitors:
+            raise SenseAPIException("No monitors: not authenticated")
+        return self.monitors[0]
+
+    active_devices = _first_monitor('active_devices')
+    devices = _first_monitor('devices')
+    active_power = _first_monitor('active_power')
+    active_solar_power = _first_monitor('active_solar_power')
+    active_voltage = _first_monitor('active_voltage')
+    active_frequency = _first_monitor('active_frequency')
+    realtime_stream = _first_monitor('realtime_stream')
+    get_realtime = _first_monitor('get_realtime')
+    get_consumption_trend = _first_monitor('get_consumption_trend')
+    get_production_trend = _first_monitor('get_production_trend')
+    get_trend = _first_monitor('get_trend')
+    start_realtime_stream = _first_monitor('start_realtime_stream')
+    stop_realtime_stream = _first_monitor('stop_realtime_stream')
+    update_realtime = _first_monitor('update_realtime')
+    get_realtime_stream = _first_monitor('get_realtime_stream')
+    get_trend_data = _first_monitor('get_trend_data')
+    update_trend_data = _first_monitor('update_trend_data')
+    get_discovered_device_names = _first_monitor('get_discovered_device_names')
+    get_discovered_device_data = _first_monitor('get_discovered_device_data')
+    always_on_info = _first_monitor('always_on_info')
+    get_monitor_info = _first_monitor('get_monitor_info')
+    get_device_info = _first_monitor('get_device_info')
+
+    def set_auth_data(self, data):
+        self.sense_access_token = data['access_token']
+        self.sense_user_id = data['user_id']
+        self.sense_monitor_id = data['monitors'][0]['id']
+
+        # monitors are kept across a new access token. Removed ones are stopped
+        known = {monitor.sense_monitor_id: monitor for monitor in self.monitors}
+        self.monitors = [known.pop(monitor['id'], None) or SenseMonitor(self, monitor['id'])
+                         for monitor in data['monitors']]
+        for monitor in known.values():
+            logger.info("sense monitor %s is gone from the account", monitor.sense_monitor_id)
+            monitor.close()
+
+        # create the auth header
+        self.headers = {'Authorization': 'bearer {}'.format(
+            self.sense_access_token)}
+
+    @property
+    def pool_size(self):
+        return len(VALID_SCALES) * max(1, len(self.monitors))
+
+    @property
+    def trend_executor(self):
+        if not self._trend_executor:
+            self._trend_executor = ThreadPoolExecutor(self.pool_size, 'sense-trend')
+        return self._trend_executor
+
+    def resize_pool(self):
+        """ Grow the trend pools to the monitors of the account. Re-authentication
+            can add monitors from a trend worker, so this is left to the caller,
+            between trend updates.
+        """
+        if self.pool_size > self._pool_size:
+            self._create_session()
+
+    def _create_session(self):
+        # Keep-alive connections for concurrent trend requests
+        self._pool_size = self.pool_size
+        if self._trend_executor:
+            self._trend_executor.shutdown(wait=False)
+            self._trend_executor = None
+        self.s = requests.session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.s.mount('https://', adapter)
+        self.s.mount('http://', adapter)
+
+    def authenticate(self, username, password):
+        auth_data = {
+            "email": username,
+            "password": password
+        }
+
+        # Get auth token
+        self.authentications += 1
+        try:
+            response = self.s.post(API_URL + 'authenticate',
+                                   auth_data, timeout=self.api_timeout)
+        except Exception as e:
+            raise Exception('Connection failure: %s' % e)
+
+        # check for 200 return
+        if response.status_code != 200:
+            raise SenseAuthenticationException(
+                "Please check username and password. API Return Code: %s" %
+                response.status_code)
+
+        data = response.json()
+        self.set_auth_data(data)
+        if self.auth_cache:
+            self.auth_cache.save(username, data)
+
+    def _reauthenticate(self, stale_token):
+        # Many callers may see the same stale token. Only the first one logs in again
+        with self._auth_lock:
+            if self.sense_access_token != stale_token:
+                return
+            if not (self.username and self.password):
+                raise SenseAuthenticationException(
+                    "Access token rejected. No credentials to renew it")
+            logger.info("sense access token rejected, authenticating again")
+            self.authenticate(self.username, self.password)
+
+    def update_all_trend_data(self, deadline=TREND_DEADLINE, force=False):
+        """ Fetch trends of all monitors at once, within deadline seconds shared
+            by all monitors and scales. Returns dict monitor -> scales updated,
+            or the exception it failed with.
+        """
+        deadline_ts = monotonic() + deadline
+        submitted = [(monitor, monitor.submit_trend_data(force)) for monitor in self.monitors]
+        results = {}
+        for monitor, futures in submitted:
+            try:
+                results[monitor] = monitor.collect_trend_data(futures, deadline_ts)
+            except Exception as e:
+                results[monitor] = e
+        return results
+
+    def close(self):
+        for monitor in self.monitors:
+            monitor.close()
+        if self._trend_executor:
+            self._trend_executor.shutdown(wait=False)
+            self._trend_executor = None
+
+    def _get(self, url, payload):
+        try:
+            return self.s.get(API_URL + url,
+                              headers=self.headers,
+                              timeout=self.api_timeout,
+                              data=payload)
+        except ReadTimeout:
+            raise SenseAPITimeoutException("API call timed out")
+
+    def api_call(self, url, payload={}):
+        token = self.sense_access_token
+        response = self._get(url, payload)
+        if response.status_code in AUTH_FAILED:
+            self._reauthenticate(token)
+            response = self._get(url, payload)
+        # an error reply must not take the place of the data it was asked for
+        if response.status_code != 200:
+            raise SenseAPIException("API call %s failed. API Return Code: %s" %
+                                    (url.split('?')[0], response.status_code))
+        return response.json()
+
     def get_all_usage_data(self):
         payload = {'n_items': 30}
         # lots of info in here to be parsed out
         return self.api_call('users/%s/timeline' %
                              (self.sense_user_id), payload)
+
+
+logger = log.getLogger()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+import threading
+from datetime import datetime
+from time import time
+
+import numpy as np
+
+WINDOWS = (600,)  # seconds
+CAPACITY = 3600  # samples kept. Memory does not grow past this, whatever the uptime
+MAX_DEVICES = 40  # devices with a column of their own. Others are not tracked
+TOTALS = ('active_power', 'active_solar_power')
+MAX_GAP = 60  # seconds. Longer gaps between samples, like a stream outage, are not integrated
+ENERGY_SCALES = ('HOUR', 'DAY')  # trend scales the energy integrator keeps up to date
+
+
+def window_label(seconds):
+    if seconds % 3600 == 0:
+        return '{}h'.format(seconds // 3600)
+    if seconds % 60 == 0:
+        return '{}m'.format(seconds // 60)
+    return '{}s'.format(seconds)
+
+
+class PowerHistory(object):
+    """ Ring buffer of realtime samples: one row per sample, with columns for total
+        power, solar power and each device seen. Statistics over a window are
+        computed on the array slice for that window. Devices named in ignore,
+        lower case, get no column.
+    """
+
+    def __init__(self, capacity=CAPACITY, max_devices=MAX_DEVICES, ignore=()):
+        self.capacity = capacity
+        self.ignore = set(ignore)
+        self.ts = np.zeros(capacity)
+        self.watts = np.zeros((capacity, len(TOTALS) + max_devices), dtype=np.float32)
+        self.columns = {name: i for i, name in enumerate(TOTALS)}
+        self.devices_skipped = 0
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def _column(self, device):
+        column = self.columns.get(device)
+        if column is None and len(self.columns) < self.watts.shape[1]:
+            column = self.columns[device] = len(self.columns)
+        return column
+
+    def add(self, realtime, ts=None):
+        """ Add one realtime update, as received from the Sense realtime feed """
+        with self._lock:
+            row = self._next
+            self.ts[row] = ts if ts is not None else time()
+            self.watts[row] = 0
+            self.watts[row, 0] = realtime.get('w', 0)
+            self.watts[row, 1] = max(0, realtime.get('solar_w', 0))
+            for device in realtime.get('devices', ()):
+                if device['name'].lower() in self.ignore:
+                    continue
+                column = self._column(device['name'])
+                if column is None:
+                    self.devices_skipped += 1
+                    continue
+                self.watts[row, column] = device.get('w', 0)
+            self._next = (row + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def _window(self, seconds, now):
+        # rows in time order, oldest first
+        with self._lock:
+            order = (np.arange(self._count) + self._next - self._count) % self.capacity
+            ts = self.ts[order]
+            watts = self.watts[order]
+        keep = ts > now - seconds
+        return ts[keep], watts[keep]
+
+    def stats(self, seconds, now=None):
+        """ Return dict column name -> (mean, peak, p95 watts, energy Wh) over the window """
+        ts, watts = self._window(seconds, now if now is not None else time())
+        if not len(ts):
+            return {}
+        mean = watts.mean(axis=0)
+        peak = watts.max(axis=0)
+        p95 = np.percentile(watts, 95, axis=0)
+        # trapezoid rule, watt seconds to watt hours
+        gaps = np.diff(ts)
+        gaps[gaps > MAX_GAP] = 0
+        energy = ((watts[1:] + watts[:-1]) / 2 * gaps[:, None]).sum(axis=0) / 3600
+        return {name: (float(mean[i]), float(peak[i]), float(p95[i]), float(energy[i]))
+                for name, i in self.columns.items()}
+
+    def topics(self, windows=WINDOWS, now=None, prefix="/sense"):
+        """ Return dict of derived <prefix>/stats topics -> values. Devices only get mean
+            and energy, and only when they drew power in the window. Unlike
+            <prefix>/data, these topics are not bridged to aio.
+        """
+        topics = {}
+        for seconds in windows:
+            label = window_label(seconds)
+            for name, (mean, peak, p95, energy) in self.stats(seconds, now).items():
+                if name in TOTALS:
+                    values = {'mean': mean, 'peak': peak, 'p95': p95, 'wh': energy}
+                elif peak > 0:
+                    name = 'device_' + name.lower().replace(' ', '_')
+                    values = {'mean': mean, 'wh': energy}
+                else:
+                    continue
+                for stat, value in values.items():
+                    topics[f"{prefix}/stats/{name}_{label}_{stat}"] = round(value, 1)
+        return topics
+
+
+def _period(scale, ts):
+    t = datetime.fromtimestamp(ts)
+    return (t.date(), t.hour) if scale == 'HOUR' else t.date()
+
+
+class _Period(object):
+    def __init__(self, key=None, synced=False):
+        self.key = key
+        self.synced = synced
+        self.base = [0.0, 0.0]  # consumption, production kWh from the last trend sync
+        self.since = [0.0, 0.0]  # kWh integrated since then
+
+
+class EnergyIntegrator(object):
+    """ Consumption and production energy of the current hour and day, in kWh,
+        integrated from realtime power between syncs with the trend totals.
+
+        A scale is synced once a trend total was applied for its current period,
+        or when the stream ran across the start of the period, which then starts
+        from zero. A gap over MAX_GAP in the stream unsyncs all scales. On sync,
+        drift is the local total minus the trend total it is replaced by.
+    """
+
+    def __init__(self, scales=ENERGY_SCALES):
+        self.drift = {}  # scale -> (consumption, production) kWh
+        self._periods = {scale: _Period() for scale in scales}
+        self._last = None  # ts, consumption watts, production watts
+        self._lock = threading.Lock()
+
+    def add(self, realtime, ts=None):
+        ts = ts if ts is not None else time()
+        watts = (realtime.get('w', 0), max(0, realtime.get('solar_w', 0)))
+        with self._lock:
+            last, self._last = self._last, (ts,) + watts
+            contiguous = last is not None and 0 <= ts - last[0] <= MAX_GAP
+            for scale, period in self._periods.items():
+                key = _period(scale, ts)
+                if period.key != key:
+                    period = self._periods[scale] = _Period(key, contiguous)
+                elif not contiguous:
+                    period.synced = False
+                if contiguous:
+                    for i, w in enumerate(watts):
+                        # trapezoid rule, watt seconds to kWh
+                        period.since[i] += (w + last[i + 1]) / 2 * (ts - last[0]) / 3.6e6
+
+    def sync(self, scale, consumption, production, ts=None):
+        """ Apply trend totals fetched at ts. Ignored if the period rolled over since """
+        ts = ts if ts is not None else time()
+        with self._lock:
+            period = self._periods.get(scale)
+            if period is None or period.key != _period(scale, ts):
+                return
+            if period.synced:
+                self.drift[scale] = tuple(b + s - t for b, s, t in zip(
+                    period.base, period.since, (consumption, production)))
+            period.base, period.since = [consumption, production], [0.0, 0.0]
+            period.synced = True
+
+    def unsynced(self):
+        with self._lock:
+            return [scale for scale, period in self._periods.items() if not period.synced]
+
+    def totals(self, scale):
+        """ Return (consumption, production) kWh, or None if scale is not synced """
+        with self._lock:
+            period = self._periods.get(scale)
+            if not period or not period.synced or period.key != _period(scale, time()):
+                return None
+            return tuple(b + s for b, s in zip(period.base, period.since))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import threading
+from time import time
+
+ON_WATTS = 10.0  # device turns on above this
+OFF_WATTS = 5.0  # and off below this. In between it keeps its state
+DEBOUNCE = 5.0  # seconds a device must stay past a threshold before its state flips
+
+
+class _Device(object):
+    def __init__(self):
+        self.on = False
+        self.since = None  # ts of last edge. None until the first one
+        self.pending_since = None  # ts the device first crossed a threshold, pending debounce
+
+
+class DeviceTransitions(object):
+    """ Incremental on/off detector over realtime updates, per device.
+
+        A device crosses into on above on_watts and into off below off_watts, and
+        the new state must hold for debounce seconds before it counts. Each edge
+        calls on_edge(device, on, ts, duration), with ts of the crossing and the
+        seconds spent in the previous state (None for the first edge). Devices
+        missing from an update are drawing no power. add() runs in the stream
+        thread while states() is read from others, so both take a lock.
+    """
+
+    def __init__(self, on_edge, on_watts=ON_WATTS, off_watts=OFF_WATTS, debounce=DEBOUNCE):
+        self.on_edge = on_edge
+        self.on_watts = on_watts
+        self.off_watts = off_watts
+        self.debounce = debounce
+        self.edges = 0
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def states(self):
+        """ Return dict device -> True if on """
+        with self._lock:
+            return {name: device.on for name, device in self._devices.items()}
+
+    def add(self, realtime, ts=None):
+        ts = ts if ts is not None else time()
+        watts = {device['name']: abs(device.get('w', 0)) for device in realtime.get('devices', ())}
+        edges = []
+        with self._lock:
+            for name in watts.keys() - self._devices.keys():
+                self._devices[name] = _Device()
+            for name, device in self._devices.items():
+                w = watts.get(name, 0)
+                crossed = w < self.off_watts if device.on else w > self.on_watts
+                if not crossed:
+                    device.pending_since = None
+                    continue
+                if device.pending_since is None:
+                    device.pending_since = ts
+                if ts - device.pending_since < self.debounce:
+                    continue
+                edge_ts, device.pending_since = device.pending_since, None
+                duration = edge_ts - device.since if device.since is not None else None
+                device.on, device.since = not device.on, edge_ts
+                self.edges += 1
+                edges.append((name, device.on, edge_ts, duration))
+        # outside the lock: on_edge may read states()
+        for edge in edges:
+            self.on_edge(*edge)
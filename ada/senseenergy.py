@@ -12,26 +12,86 @@ from six.moves import queue
 
 from ada import events
 from ada import log
+from ada import sense_stats
+from ada import sense_transitions
+from .sense_api import AUTH_CACHE
+from .sense_api import AuthCache
 from .sense_api import SenseApi
+from .sense_api import REALTIME_INTERVAL
 from .sense_api import VALID_SCALES as sense_scales
 
 CMDQ_SIZE = 100
 CMDQ_GET_TIMEOUT = 601  # seconds.
+IGNORE_DEVICES = {'other', 'always on'}
 _state = None
 
+# Seconds between realtime updates kept from the stream. 0 connects per fetch instead
+SENSE_REALTIME_INTERVAL = float(env.get('SENSE_REALTIME_INTERVAL', REALTIME_INTERVAL))
+# Seconds of realtime history for derived statistics topics. Empty for none
+SENSE_STATS_WINDOWS = [int(w) for w in env.get(
+    'SENSE_STATS_WINDOWS', ','.join(map(str, sense_stats.WINDOWS))).split(',') if w]
+# Device on/off from edges on the realtime stream, instead of a sample per fetch
+SENSE_DEVICE_TRANSITIONS = env.get('SENSE_DEVICE_TRANSITIONS', 'yes') == 'yes'
+SENSE_DEVICE_ON_WATTS = float(env.get('SENSE_DEVICE_ON_WATTS', sense_transitions.ON_WATTS))
+SENSE_DEVICE_OFF_WATTS = float(env.get('SENSE_DEVICE_OFF_WATTS', sense_transitions.OFF_WATTS))
+SENSE_DEVICE_DEBOUNCE = float(env.get('SENSE_DEVICE_DEBOUNCE', sense_transitions.DEBOUNCE))
+# Hour and day energy integrated from the realtime stream, synced with trends this often
+SENSE_ENERGY_SYNC_INTERVAL = int(env.get('SENSE_ENERGY_SYNC_INTERVAL', '3600'))
+
 
 def use_sense_energy():
     return env.get('SENSE_USERNAME') and env.get('SENSE_PASSWORD')
 
 
+class MonitorState(object):
+    """ What the sense process keeps for one monitor. The first monitor of the
+        account publishes under /sense, others under /sense/<monitor id>
+    """
+
+    def __init__(self, monitor_id, primary):
+        self.monitor_id = monitor_id
+        self.prefix = "/sense" if primary else f"/sense/{monitor_id}"
+        self.metric_prefix = "sense" if primary else f"sense_{monitor_id}"
+        self.all_devices = None
+        self.snapshot = {}  # topics of this monitor, from its last good fetch
+        self.power_history = None
+        if SENSE_REALTIME_INTERVAL and SENSE_STATS_WINDOWS:
+            # sized for the longest window, so memory stays bounded
+            capacity = int(max(SENSE_STATS_WINDOWS) / SENSE_REALTIME_INTERVAL) + 1
+            self.power_history = sense_stats.PowerHistory(capacity, ignore=IGNORE_DEVICES)
+        self.transitions = None
+        if SENSE_REALTIME_INTERVAL and SENSE_DEVICE_TRANSITIONS:
+            self.transitions = sense_transitions.DeviceTransitions(
+                self._on_edge, SENSE_DEVICE_ON_WATTS, SENSE_DEVICE_OFF_WATTS,
+                SENSE_DEVICE_DEBOUNCE)
+        self.energy = None
+        if SENSE_REALTIME_INTERVAL and SENSE_ENERGY_SYNC_INTERVAL:
+            self.energy = sense_stats.EnergyIntegrator()
+
+    def _on_edge(self, device, on, ts, duration):
+        _notifySenseDeviceEvent(self, device, on, ts, duration)
+
+    def on_realtime_update(self, realtime):
+        # Called from the realtime stream thread of the monitor
+        ts = time.time()
+        if self.power_history:
+            self.power_history.add(realtime, ts)
+        if self.transitions:
+            self.transitions.add(realtime, ts)
+        if self.energy:
+            self.energy.add(realtime, ts)
+
+
 class State(object):
     def __init__(self, queueEventFun):
         self.queueEventFun = queueEventFun  # queue for output events
         self.cmdq = multiprocessing.Queue(CMDQ_SIZE)  # queue for input commands
         self.last_fetch_ts = datetime.now()
         self.sense_api = None
-        self.all_devices = None
+        self.monitors = {}  # monitor id -> MonitorState
         self.sense_api_fails = 0
+        self.last_snapshot = {}  # topic -> value, as last sent downstream
+        self.callback_error = None
 
 
 # =============================================================================
@@ -48,24 +108,89 @@ def do_init(queueEventFun=None):
 
 # =============================================================================
 
-def _notifySenseEnergyEvent(collected_values):
-    global _state
-    logger.info("got sense energy values %s", collected_values)
-    if not _state.queueEventFun:
-        return
+def _device_key(device):
+    return device.lower().replace(' ', '_')
+
 
+def _snapshot(mstate, collected_values, full):
     # Deal with devices separately
-    all_devices = sorted(collected_values.pop('all_devices'))
     active_devices = collected_values.pop('active_devices')
 
-    for key, value in collected_values.items():
-        _state.queueEventFun(events.SenseEnergyEvent(f"/sense/data/{key}", value))
-        time.sleep(1.2)
+    snapshot = {f"{mstate.prefix}/data/{key}": value for key, value in collected_values.items()}
+    if mstate.power_history:
+        snapshot.update(mstate.power_history.topics(SENSE_STATS_WINDOWS, prefix=mstate.prefix))
+    if mstate.transitions and not full:
+        # edges already went downstream as they happened. Full snapshot has them all
+        return snapshot
+    snapshot.update(_device_topics(mstate, active_devices))
+    return snapshot
 
-    for device in all_devices:
-        value = 'on' if device in active_devices else 'off'
-        _state.queueEventFun(events.SenseEnergyEvent(f"/sense/device/{device}", value))
-        time.sleep(1.6)
+
+def _device_topics(mstate, active_devices=()):
+    if mstate.transitions:
+        states = {_device_key(device): on for device, on in mstate.transitions.states().items()}
+        active_devices = {device for device, on in states.items() if on}
+    return {f"{mstate.prefix}/device/{device}": 'on' if device in active_devices else 'off'
+            for device in sorted(_device_key(device) for device in mstate.all_devices or ())}
+
+
+def _notifySenseDeviceEvent(mstate, device, on, ts, duration):
+    # Called from the realtime stream thread, on each debounced edge
+    global _state
+    known_devices = mstate.all_devices
+    if device.lower() in IGNORE_DEVICES or (known_devices and device not in known_devices):
+        return
+    state = 'on' if on else 'off'
+    logger.info("sense %s device %s %s after %s seconds", mstate.monitor_id, device, state,
+                duration)
+    if _state.queueEventFun:
+        _notifyEventFromCallback(events.SenseDeviceEvent(mstate.prefix, _device_key(device),
+                                                         state, ts, duration))
+
+
+def _notifyEventFromCallback(event):
+    # Runs in the stream thread. A full event queue must still stop this
+    # process, so the error is raised again from do_iterate, woken up for it
+    global _state
+    try:
+        _state.queueEventFun(event)
+    except RuntimeError as e:
+        logger.error("unable to notify event from callback: %s", e)
+        _state.callback_error = e
+        _enqueue_cmd((_raise_callback_error, []))
+
+
+def _raise_callback_error():
+    raise _state.callback_error
+
+
+def _sync_energy(mstate, monitor, updated_scales, fetch_ts):
+    # Trend totals are authoritative. Local totals continue from them
+    for scale in updated_scales:
+        if scale not in sense_stats.ENERGY_SCALES:
+            continue
+        mstate.energy.sync(scale, monitor.get_consumption_trend(scale),
+                           monitor.get_production_trend(scale), fetch_ts)
+        drift = mstate.energy.drift.pop(scale, None)
+        if drift:
+            logger.info("sense %s %s energy drift consumption %.3f production %.3f kWh",
+                        mstate.monitor_id, scale, *drift)
+            name = f'{mstate.metric_prefix}_energy_drift_{scale.lower()}'
+            _notifyMetricEvent(f'{name}_consumption', round(drift[0], 4))
+            _notifyMetricEvent(f'{name}_production', round(drift[1], 4))
+
+
+def _notifySenseEnergyEvent(snapshot, full=False):
+    # One event per fetch, with only what changed. Pacing is up to who publishes it
+    global _state
+    logger.info("got sense energy values %s", snapshot)
+    last_snapshot = {} if full else _state.last_snapshot
+    changes = {topic: value for topic, value in snapshot.items()
+               if last_snapshot.get(topic) != value}
+    _state.last_snapshot = snapshot
+    if not changes or not _state.queueEventFun:
+        return
+    _state.queueEventFun(events.SenseEnergyEvent(changes))
 
 
 # =============================================================================
@@ -75,6 +200,9 @@ def _notifySenseEnergyEvent(collected_values):
 def do_iterate():
     global _state
 
+    if _state.callback_error:
+        raise _state.callback_error
+
     try:
         cmdDill = _state.cmdq.get(True, CMDQ_GET_TIMEOUT)
         cmdFun, params = dill.loads(cmdDill)
@@ -93,67 +221,147 @@ def do_iterate():
 # =============================================================================
 
 
-def _fetch():
+def _notifyMetricEvent(name, value):
     global _state
+    if _state.queueEventFun:
+        _state.queueEventFun(events.MetricEvent(name, value))
 
+
+def _start_api():
+    global _state
+    _state.sense_api = SenseApi(
+        username=env.get('SENSE_USERNAME'),
+        password=env.get('SENSE_PASSWORD'),
+        auth_cache=AuthCache(AUTH_CACHE) if AUTH_CACHE else None)
+
+
+def _monitor_state(monitor, primary):
+    # Monitors can show up with any new access token, so look for them on every fetch
+    global _state
+    mstate = _state.monitors.get(monitor.sense_monitor_id)
+    if not mstate:
+        mstate = _state.monitors[monitor.sense_monitor_id] = MonitorState(
+            monitor.sense_monitor_id, primary)
+    if SENSE_REALTIME_INTERVAL:
+        monitor.start_realtime_stream(SENSE_REALTIME_INTERVAL, mstate.on_realtime_update)
+    if mstate.energy:
+        for scale in sense_stats.ENERGY_SCALES:
+            monitor.trend_max_age[scale] = SENSE_ENERGY_SYNC_INTERVAL
+    return mstate
+
+
+def _collect(mstate, monitor):
     collected_values = {}
+    monitor.update_realtime()
+
+    # Load up all devices, once
+    if not mstate.all_devices:
+        monitor_info = monitor.get_monitor_info()
+        logger.info(f"sense monitor {mstate.monitor_id} info {monitor_info}")
+        mstate.all_devices = {
+            device
+            for device in monitor.get_discovered_device_names()
+            if device.lower() not in IGNORE_DEVICES}
+        logger.info(f"sense monitor {mstate.monitor_id} known devices are {mstate.all_devices}")
+
+    collected_values['active_power'] = monitor.active_power
+    # Include solar only if it is making meaningful power (more than 2 watts)
+    active_solar_power = monitor.active_solar_power
+    collected_values['active_solar_power'] = active_solar_power if (
+            active_solar_power > 2) else 0
+    collected_values['grid_power'] = (collected_values['active_power'] -
+            collected_values['active_solar_power'])
+    collected_values['active_devices'] = {
+        device.lower().replace(' ', '_')
+        for device in monitor.active_devices
+        if device in mstate.all_devices and (
+            device.lower() != 'solar' or collected_values['active_solar_power'])}
+
+    for sense_scale in sense_scales:
+        scale_key = 'consumption_{}'.format(sense_scale.lower())
+        collected_values[scale_key] = monitor.get_consumption_trend(sense_scale)
+
+        scale_key = 'production_{}'.format(sense_scale.lower())
+        collected_values[scale_key] = monitor.get_production_trend(sense_scale)
+
+        # continuously updated between trend syncs, at no network cost
+        totals = mstate.energy.totals(sense_scale) if mstate.energy else None
+        if totals:
+            collected_values[scale_key] = round(totals[1], 3)
+            scale_key = 'consumption_{}'.format(sense_scale.lower())
+            collected_values[scale_key] = round(totals[0], 3)
+    return collected_values
+
+
+def _fetch(force=False):
+    global _state
+
+    snapshot = {}
+    failed = {}
     try:
         with stopit.ThreadingTimeout(28.90, swallow_exc=False) as timeout_ctx:
             if not _state.sense_api:
-                _state.sense_api = SenseApi(
-                    username=env.get('SENSE_USERNAME'),
-                    password=env.get('SENSE_PASSWORD'))
-            _state.sense_api.update_realtime()
-            _state.sense_api.update_trend_data()
-
-            ignore_devices = {'other', 'always on'}
-            # Load up all devices, once
-            if not _state.all_devices:
-                monitor_info = _state.sense_api.get_monitor_info()
-                logger.info(f"sense monitor info {monitor_info}")
-                _state.all_devices = {
-                    device
-                    for device in _state.sense_api.get_discovered_device_names()
-                    if device.lower() not in ignore_devices}
-                logger.info(f"sense known devices are {_state.all_devices}")
-
-            collected_values['active_power'] = _state.sense_api.active_power
-            # Include solar only if it is making meaningful power (more than 2 watts)
-            active_solar_power = _state.sense_api.active_solar_power
-            collected_values['active_solar_power'] = active_solar_power if (
-                    active_solar_power > 2) else 0
-            collected_values['grid_power'] = (collected_values['active_power'] -
-                    collected_values['active_solar_power'])
-            collected_values['all_devices'] = [
-                device.lower().replace(' ', '_')
-                for device in _state.all_devices]
-            collected_values['active_devices'] = {
-                device.lower().replace(' ', '_')
-                for device in _state.sense_api.active_devices
-                if device in _state.all_devices and (
-                    device.lower() != 'solar' or collected_values['active_solar_power'])}
-
-            for sense_scale in sense_scales:
-                scale_key = 'consumption_{}'.format(sense_scale.lower())
-                collected_values[scale_key] = _state.sense_api.get_consumption_trend(sense_scale)
-
-                scale_key = 'production_{}'.format(sense_scale.lower())
-                collected_values[scale_key] = _state.sense_api.get_production_trend(sense_scale)
+                _start_api()
+            # monitors may have come with a new access token since the last fetch
+            _state.sense_api.resize_pool()
+            monitors = _state.sense_api.monitors
+            for i, monitor in enumerate(monitors):
+                mstate = _monitor_state(monitor, primary=i == 0)
+                for scale in mstate.energy.unsynced() if mstate.energy else ():
+                    monitor.expire_trend(scale)
+            fetch_ts = time.time()
+            # trends of all monitors at once
+            results = _state.sense_api.update_all_trend_data(force=force)
+
+            for monitor in monitors:
+                mstate = _state.monitors[monitor.sense_monitor_id]
+                try:
+                    if isinstance(results[monitor], Exception):
+                        raise results[monitor]
+                    if mstate.energy:
+                        _sync_energy(mstate, monitor, results[monitor], fetch_ts)
+                    mstate.snapshot = _snapshot(mstate, _collect(mstate, monitor), force)
+                except Exception as e:
+                    failed[mstate.monitor_id] = e
+                # a failed monitor keeps its last values, so they are not seen as changes
+                snapshot.update(mstate.snapshot)
+            if len(failed) == len(monitors):
+                raise Exception("all monitors failed: {}".format(failed))
 
         _state.sense_api_fails = 0
     except Exception as e:
         _state.sense_api_fails += 1
         logger.error("failed to fetch sense_api %s %s fails %d timeout_ctx %s",
-                     collected_values, timeout_ctx, _state.sense_api_fails, e)
+                     snapshot, timeout_ctx, _state.sense_api_fails, e)
         # Try to clear fails by starting api session over
         if _state.sense_api_fails > 2:
+            if _state.sense_api:
+                _state.sense_api.close()
             _state.sense_api = None
             _state.sense_api_fails = 0
         return
-    _notifySenseEnergyEvent(collected_values)
+    if failed:
+        logger.warning("failed to fetch sense monitors %s", failed)
+    _notifySenseEnergyEvent(snapshot, full=force)
+    monitors = _state.sense_api.monitors
+    _notifyMetricEvent('sense_trend_calls', sum(m.trend_calls for m in monitors))
+    _notifyMetricEvent('sense_trend_calls_saved', sum(m.trend_calls_saved for m in monitors))
     _state.last_fetch_ts = datetime.now()
 
 
+def _resend():
+    # Downstream lost what it had: send the values of the last good fetches
+    # again, devices included. No api calls
+    snapshot = {}
+    for mstate in _state.monitors.values():
+        snapshot.update(mstate.snapshot)
+        if mstate.transitions:
+            snapshot.update(_device_topics(mstate))
+    if not snapshot:
+        return  # nothing fetched yet. The first fetch sends it all
+    _notifySenseEnergyEvent(snapshot, full=True)
+
+
 # =============================================================================
 
 
@@ -168,12 +376,20 @@ def _enqueue_cmd(l_dill_raw):
     return True
 
 
-# external to this module
-def do_fetch():
-    params = []
+# external to this module. force fetches all trend scales, fresh or not, and
+# sends all values downstream, changed or not
+def do_fetch(force=False):
+    params = [force]
     return _enqueue_cmd((_fetch, params))
 
 
+# external to this module. Send the last fetched values downstream again,
+# changed or not, without fetching
+def do_resend():
+    params = []
+    return _enqueue_cmd((_resend, params))
+
+
 # =============================================================================
 
 
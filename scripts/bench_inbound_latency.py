@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# End to end inbound latency of the local mqtt adapter, against a local broker:
+# time from a publish until its MqttMsgEvent is read from the main event queue.
+#
+#   mosquitto -p 1883 &
+#   PYTHONPATH=/vagrant MQTT_LOCAL_BROKER_IP=localhost ./bench_inbound_latency.py
+
+import multiprocessing
+import sys
+import time
+from os import environ as env
+
+import paho.mqtt.client as mqtt
+
+from ada import mqttclient
+
+COUNT = int(env.get('COUNT', '2000'))
+TOPIC = '/bench/inbound_latency'
+
+
+class Child(multiprocessing.Process):
+    """ The adapter runs in its own process, like it does under ada.main """
+
+    def __init__(self, eventq):
+        multiprocessing.Process.__init__(self)
+        self.eventq = eventq
+        self.cmdq = mqttclient.do_init(self.eventq.put)
+        mqttclient._state.topics = [TOPIC]
+
+    def run(self):
+        while True:
+            mqttclient.do_iterate()
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    eventq = multiprocessing.Queue(1000)
+    child = Child(eventq)
+    child.start()
+    # wait for the adapter to connect
+    while eventq.get(True, 10).name != "MqttConnectEvent":
+        pass
+
+    publisher = mqtt.Client()
+    publisher.connect(env.get('MQTT_LOCAL_BROKER_IP', 'localhost'))
+    publisher.loop_start()
+
+    latencies = []
+    for i in range(COUNT):
+        sent = time.time()
+        publisher.publish(TOPIC, str(i), 1)
+        event = eventq.get(True, 10)
+        while event.name != "MqttMsgEvent":
+            event = eventq.get(True, 10)
+        latencies.append(time.time() - sent)
+
+    child.terminate()
+    publisher.loop_stop()
+    latencies.sort()
+    print('{} messages latency ms: avg {:.3f} p50 {:.3f} p95 {:.3f} p99 {:.3f} max {:.3f}'.format(
+        COUNT, 1000 * sum(latencies) / COUNT,
+        1000 * percentile(latencies, 50), 1000 * percentile(latencies, 95),
+        1000 * percentile(latencies, 99), 1000 * latencies[-1]))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
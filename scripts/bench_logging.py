@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Hot path cost of logging every inbound message, like the adapters do, to a
+# syslog handler: written synchronously, handed over to the writer thread of
+# ada.log, and handed over with the per call site rate limit.
+#
+#   PYTHONPATH=/vagrant ./bench_logging.py
+
+import logging
+import socket
+import time
+from logging.handlers import SysLogHandler
+from os import environ as env
+
+from ada import log
+
+COUNT = int(env.get('COUNT', '100000'))
+TOPIC = 'zwave/shed/notification/endpoint_0/Home_Security/Motion_sensor_status'
+
+
+def syslog_handler():
+    # udp sink on localhost, so no syslog daemon is needed
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('localhost', 0))
+    handler = SysLogHandler(address=sink.getsockname(), facility=SysLogHandler.LOG_DAEMON)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s [adaio] %(module)12s:%(lineno)-d %(levelname)-8s %(message)s'))
+    return sink, handler
+
+
+def bench(logger):
+    start = time.perf_counter()
+    for i in range(COUNT):
+        logger.info("got mqtt message %s %s", TOPIC, i)
+    return time.perf_counter() - start
+
+
+def main():
+    logger = log.getLogger()
+    logger.setLevel(logging.INFO)
+    sink, handler = syslog_handler()
+
+    logger.addHandler(handler)
+    sync = bench(logger)
+    logger.removeHandler(handler)
+
+    log._start_writer([handler])
+    queued = bench(logger)
+    waiting, dropped, _ = log.stats()
+    log.flush()
+    logger.removeHandler(handler)
+
+    log._rate_filter = log.RateLimitFilter()
+    logger.addFilter(log._rate_filter)
+    log._start_writer([handler])
+    limited = bench(logger)
+    suppressed = log.stats()[2]
+    log.flush()
+    logger.removeHandler(handler)
+    sink.close()
+
+    print('{} info lines, hot path cost per line'.format(COUNT))
+    print('  synchronous syslog : {:7.2f} us'.format(1e6 * sync / COUNT))
+    print('  writer thread      : {:7.2f} us  waiting at end {} dropped {}'.format(
+        1e6 * queued / COUNT, waiting, dropped))
+    print('  writer + rate limit: {:7.2f} us  suppressed {}'.format(
+        1e6 * limited / COUNT, suppressed))
+
+
+if __name__ == "__main__":
+    main()
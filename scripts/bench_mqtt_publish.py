@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Publish throughput of the local mqtt adapter, against a local broker.
+# Compares pipelined publishes of ada.mqttclient with publishes that wait
+# for each completion, like the adapter used to do.
+#
+#   mosquitto -p 1883 &
+#   PYTHONPATH=/vagrant MQTT_LOCAL_BROKER_IP=localhost ./bench_mqtt_publish.py
+
+import sys
+import time
+from os import environ as env
+
+from ada import mqttclient
+
+COUNT = int(env.get('COUNT', '5000'))
+QOS = int(env.get('QOS', '1'))
+TOPIC = '/bench/mqtt_publish'
+
+
+def wait_for(cond, timeout):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+def bench_serial(client):
+    start = time.monotonic()
+    for i in range(COUNT):
+        info = client.publish(TOPIC, i, QOS)
+        info.wait_for_publish()
+    return time.monotonic() - start
+
+
+def bench_pipelined():
+    state = mqttclient._state
+    start = time.monotonic()
+    for i in range(COUNT):
+        mqttclient._mqtt_publish(TOPIC, i, QOS)
+    wait_for(lambda: not state.inflight, 60)
+    return time.monotonic() - start
+
+
+def main():
+    mqttclient.do_init(None)
+    state = mqttclient._state
+    state.mqtt_client = mqttclient._setup_mqtt_client(state.mqtt_broker_ip, 'bench_mqtt_publish',
+                                                      [])
+    state.mqtt_client.loop_start()
+    if not wait_for(state.mqtt_client.is_connected, 10):
+        print('unable to connect to {}'.format(state.mqtt_broker_ip))
+        sys.exit(1)
+
+    serial = bench_serial(state.mqtt_client)
+    pipelined = bench_pipelined()
+    print('{} publishes qos {}'.format(COUNT, QOS))
+    print('  wait each : {:.3f}s {:8.0f} msg/s'.format(serial, COUNT / serial))
+    print('  pipelined : {:.3f}s {:8.0f} msg/s window {}'.format(
+        pipelined, COUNT / pipelined, mqttclient.INFLIGHT_WINDOW))
+    state.mqtt_client.disconnect()
+    state.mqtt_client.loop_stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Wire bytes sent by the local mqtt adapter with MQTT 3.1.1 and with MQTT v5 topic
+# aliases, against a local v5 broker. A small tcp proxy between the adapter and the
+# broker counts the bytes. Broker must allow topic aliases, e.g. in mosquitto.conf:
+#   listener 1883
+#   allow_anonymous true
+#   max_topic_alias 10
+#
+#   mosquitto -c mosquitto.conf &
+#   PYTHONPATH=/vagrant MQTT_LOCAL_BROKER_IP=localhost ./bench_mqtt_v5.py
+
+import socket
+import sys
+import threading
+import time
+from os import environ as env
+
+from ada import mqttclient
+
+COUNT = int(env.get('COUNT', '5000'))
+EXPIRY = env.get('EXPIRY', '60')
+TOPIC = 'zwave/shed/notification/endpoint_0/Home_Security/Motion_sensor_status'
+
+
+class CountingProxy(object):
+    """ Forwards one connection at a time to the broker, counting bytes sent to it """
+
+    def __init__(self, broker_ip, broker_port):
+        self.broker = (broker_ip, broker_port)
+        self.sent = 0
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('localhost', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            downstream, _ = self.listener.accept()
+            upstream = socket.create_connection(self.broker)
+            threading.Thread(target=self._pipe, args=(downstream, upstream, True),
+                             daemon=True).start()
+            threading.Thread(target=self._pipe, args=(upstream, downstream, False),
+                             daemon=True).start()
+
+    def _pipe(self, src, dst, count):
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                if count:
+                    self.sent += len(data)
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            dst.close()
+
+
+def wait_for(cond, timeout):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def wait_quiet(proxy):
+    # qos0 has no completion, so wait for the byte count to settle
+    last = -1
+    while proxy.sent != last:
+        last = proxy.sent
+        time.sleep(0.2)
+
+
+def bench(protocol, expiry):
+    env['MQTT_LOCAL_PROTOCOL'] = protocol
+    env['MQTT_LOCAL_MESSAGE_EXPIRY'] = expiry
+    mqttclient.do_init(None)
+    state = mqttclient._state
+    proxy = CountingProxy(state.mqtt_broker_ip, state.mqtt_broker_port)
+    state.mqtt_client = mqttclient._setup_mqtt_client('localhost', 'bench_mqtt_v5', [],
+                                                      proxy.port, state.protocol)
+    state.mqtt_client.loop_start()
+    if not wait_for(state.mqtt_client.is_connected, 10):
+        print('unable to connect to {}:{}'.format(state.mqtt_broker_ip, state.mqtt_broker_port))
+        sys.exit(1)
+    # connect event is normally handled from the command queue
+    state.connected = True
+    wait_quiet(proxy)
+    start = proxy.sent
+    for i in range(COUNT):
+        mqttclient._mqtt_publish(TOPIC, i, 0)
+    wait_quiet(proxy)
+    sent = proxy.sent - start
+    aliased = len(state.topic_aliases.aliases)
+    state.mqtt_client.disconnect()
+    state.mqtt_client.loop_stop()
+    return sent, aliased
+
+
+def main():
+    print('{} qos0 publishes to {}'.format(COUNT, TOPIC))
+    baseline = None
+    for name, protocol, expiry in (('mqtt 3.1.1', '3', '0'),
+                                   ('mqtt v5', '5', '0'),
+                                   ('mqtt v5 expiry {}s'.format(EXPIRY), '5', EXPIRY)):
+        sent, aliased = bench(protocol, expiry)
+        baseline = baseline or sent
+        print('  {:20}: {:9} bytes {:7.1f} bytes/msg {:6.1%} aliases {}'.format(
+            name, sent, sent / COUNT, sent / baseline, aliased))
+    if not aliased:
+        print('broker granted no topic aliases, check max_topic_alias')
+
+
+if __name__ == "__main__":
+    main()
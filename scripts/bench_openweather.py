@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Requests and wall clock time to fetch current weather for N locations
+# against the local OpenWeather stand-in: one weather request per city, and
+# the group endpoint with up to 20 cities per request. Then a fetch with a
+# warm cache, which should make no requests at all.
+#
+#   PYTHONPATH=/vagrant ./bench_openweather.py
+#   PYTHONPATH=/vagrant LATENCY=0.2 LOCATIONS=1,5,50 ./bench_openweather.py
+
+import subprocess
+import sys
+import time
+from os import environ as env
+from os import path
+
+PORT = env.get('PORT', '18780')
+env['OPENWEATHER_URL'] = 'http://localhost:%s/' % PORT
+env['OPENWEATHER_API'] = 'key'
+
+from ada import oweather  # noqa: E402 (reads OPENWEATHER_URL)
+
+STANDIN = path.join(path.dirname(path.abspath(__file__)), 'openweather_standin.py')
+LATENCY = env.get('LATENCY', '0.1')
+LOCATIONS = [int(n) for n in env.get('LOCATIONS', '1,5,20,50').split(',')]
+FIRST_CITY_ID = 5128000
+
+
+def fetch(n, use_group, warm=False):
+    received = []
+    oweather.do_init(received.append)
+    state = oweather._state
+    state.locations = oweather.parse_locations(
+        ','.join(str(FIRST_CITY_ID + i) for i in range(n)))
+    state.use_group = use_group
+    if warm:
+        oweather._fetch()
+        state.calls = 0
+    start = time.monotonic()
+    oweather._fetch()
+    elapsed = time.monotonic() - start
+    weather = [event for event in received if event.name == 'OpenWeatherEvent']
+    assert len(weather) == n * (2 if warm else 1), 'missing weather'
+    return state.calls, elapsed
+
+
+def main():
+    standin = subprocess.Popen([sys.executable, STANDIN], env=dict(env, PORT=PORT,
+                                                                  LATENCY=LATENCY))
+    time.sleep(1)
+    try:
+        print('latency {}s per request'.format(LATENCY))
+        print('  {:>9} | {:>20} | {:>20} | {:>20}'.format(
+            'locations', 'one per city', 'group', 'warm cache'))
+        for n in LOCATIONS:
+            row = ['{:>4} requests {:.3f}s'.format(calls, elapsed)
+                   for calls, elapsed in (fetch(n, False), fetch(n, True),
+                                                   fetch(n, True, warm=True))]
+            print('  {:>9} | {:>20} | {:>20} | {:>20}'.format(n, *row))
+    finally:
+        standin.terminate()
+
+
+if __name__ == "__main__":
+    main()
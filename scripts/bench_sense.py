@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Benchmark of the Sense adapter against the local stand-in, which serves
+# recorded responses:
+#  - fetch latency: realtime snapshot, trends of all monitors and devices, as
+#    one fetch of senseenergy does, with percentiles and failures
+#  - stream throughput: realtime updates received and handled by the stream
+#    thread with the statistics, transitions and energy the adapter keeps
+#  - handling throughput: the same work on recorded frames, without a socket
+# Stand-in knobs (LATENCY, TREND_LATENCY, ERROR_RATE, WS_ERROR_RATE, FRAME_RATE,
+# MONITORS, ...) are passed through from the environment.
+#
+#   PYTHONPATH=/vagrant ./bench_sense.py
+#   PYTHONPATH=/vagrant ERROR_RATE=0.1 LATENCY=0.05 FRAME_RATE=200 ./bench_sense.py
+
+import subprocess
+import sys
+import time
+from os import environ as env
+from os import path
+
+PORT = env.get('PORT', '18765')
+env['SENSE_WS_URL'] = 'ws://localhost:%s/monitors/%%s/realtimefeed?access_token=%%s' % PORT
+env['SENSE_API_URL'] = 'http://localhost:%s/' % (int(PORT) + 1)
+
+from ada import sense_api  # noqa: E402 (reads SENSE_WS_URL and SENSE_API_URL)
+from ada import sense_stats  # noqa: E402
+from ada import sense_transitions  # noqa: E402
+
+SCRIPTS = path.dirname(path.abspath(__file__))
+STANDIN = path.join(SCRIPTS, 'sense_standin.py')
+FRAMES = path.join(SCRIPTS, 'fixtures', 'sense_frames.jsonl')
+ROUNDS = int(env.get('ROUNDS', '20'))
+SECONDS = int(env.get('SECONDS', '5'))
+FORCE = env.get('FORCE', 'yes') == 'yes'  # fetch all trend scales every round
+HANDLED = int(env.get('HANDLED', '100000'))  # recorded frames for handling throughput
+
+
+class Handler(object):
+    """ What the adapter does with each realtime update """
+
+    def __init__(self):
+        self.history = sense_stats.PowerHistory()
+        self.transitions = sense_transitions.DeviceTransitions(lambda *_args: None)
+        self.energy = sense_stats.EnergyIntegrator()
+        self.handled = 0
+        self.busy = 0.0
+
+    def __call__(self, realtime, ts=None):
+        start = time.perf_counter()
+        ts = ts if ts is not None else time.time()
+        self.history.add(realtime, ts)
+        self.transitions.add(realtime, ts)
+        self.energy.add(realtime, ts)
+        self.handled += 1
+        self.busy += time.perf_counter() - start
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0
+
+
+def fetch(api):
+    for monitor in api.monitors:
+        monitor.update_realtime()
+    results = api.update_all_trend_data(force=FORCE)
+    for monitor, result in results.items():
+        if isinstance(result, Exception):
+            raise result
+        monitor.get_discovered_device_names()
+
+
+def bench_fetch(api):
+    elapsed, failed = [], []
+    for _ in range(ROUNDS):
+        start = time.monotonic()
+        try:
+            fetch(api)
+        except Exception as e:
+            failed.append(type(e).__name__)
+        elapsed.append(time.monotonic() - start)
+    print('fetch latency, {} rounds over {} monitors:'.format(ROUNDS, len(api.monitors)))
+    print('  p50 {:.3f}s p95 {:.3f}s max {:.3f}s failed {} {}'.format(
+        percentile(elapsed, 50), percentile(elapsed, 95), max(elapsed), len(failed),
+        sorted(set(failed))))
+    print('  trend calls {} saved {}'.format(
+        sum(m.trend_calls for m in api.monitors), sum(m.trend_calls_saved for m in api.monitors)))
+
+
+def bench_stream(api):
+    handlers = []
+    for monitor in api.monitors:
+        handlers.append(Handler())
+        monitor.start_realtime_stream(0, handlers[-1])
+    time.sleep(SECONDS)
+    streams = [monitor.realtime_stream for monitor in api.monitors]
+    handled = sum(handler.handled for handler in handlers)
+    busy = sum(handler.busy for handler in handlers)
+    print('stream throughput, {}s at {} frames/s per monitor:'.format(
+        SECONDS, env.get('FRAME_RATE', '2')))
+    print('  {:.1f} updates/s handled, {:.1f}us each, reconnects {}'.format(
+        handled / SECONDS, busy / max(handled, 1) * 1e6,
+        sum(stream.reconnects for stream in streams)))
+
+
+def bench_handling():
+    import json
+    with open(FRAMES) as f:
+        updates = [frame['payload'] for frame in map(json.loads, f)
+                   if frame['type'] == 'realtime_update']
+    handler = Handler()
+    ts = time.time()
+    start = time.perf_counter()
+    for i in range(HANDLED):
+        handler(updates[i % len(updates)], ts + i)
+    elapsed = time.perf_counter() - start
+    print('handling throughput, {} recorded updates:'.format(HANDLED))
+    print('  {:.0f} updates/s, {:.1f}us each'.format(HANDLED / elapsed, elapsed / HANDLED * 1e6))
+
+
+def main():
+    standin = subprocess.Popen([sys.executable, STANDIN], env=dict(env, PORT=PORT))
+    time.sleep(1)
+    try:
+        api = None
+        for _ in range(10):
+            try:
+                api = sense_api.SenseApi('user@example.com', 'password')
+                break
+            except Exception:
+                pass  # injected errors
+        bench_fetch(api)
+        bench_stream(api)
+        api.close()
+        bench_handling()
+    finally:
+        standin.terminate()
+
+
+if __name__ == "__main__":
+    main()
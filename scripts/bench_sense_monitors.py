@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Wall clock time to fetch Sense trends of all monitors of an account against
+# the local stand-in: one monitor after the other, and all monitors at once
+# over the shared session. Then the realtime stream of each monitor, to check
+# they all get their own updates.
+#
+#   PYTHONPATH=/vagrant ./bench_sense_monitors.py
+#   PYTHONPATH=/vagrant MONITORS=8 TREND_LATENCY=0.5 ./bench_sense_monitors.py
+
+import subprocess
+import sys
+import time
+from os import environ as env
+from os import path
+
+PORT = env.get('PORT', '18765')
+env['SENSE_WS_URL'] = 'ws://localhost:%s/monitors/%%s/realtimefeed?access_token=%%s' % PORT
+env['SENSE_API_URL'] = 'http://localhost:%s/' % (int(PORT) + 1)
+
+from ada import sense_api  # noqa: E402 (reads SENSE_WS_URL and SENSE_API_URL)
+
+STANDIN = path.join(path.dirname(path.abspath(__file__)), 'sense_standin.py')
+ROUNDS = int(env.get('ROUNDS', '3'))
+MONITORS = env.get('MONITORS', '3')
+TREND_LATENCY = env.get('TREND_LATENCY', '0.2')
+
+
+def one_by_one(api):
+    return {monitor: monitor.update_trend_data(force=True) for monitor in api.monitors}
+
+
+def all_at_once(api):
+    return api.update_all_trend_data(force=True)
+
+
+def bench(api, fetch):
+    elapsed, results = [], None
+    for _ in range(ROUNDS):
+        start = time.monotonic()
+        results = fetch(api)
+        elapsed.append(time.monotonic() - start)
+    failed = sum(isinstance(result, Exception) for result in results.values())
+    return sum(elapsed) / ROUNDS, max(elapsed), failed
+
+
+def main():
+    standin = subprocess.Popen([sys.executable, STANDIN], env=dict(
+        env, PORT=PORT, MONITORS=MONITORS, TREND_LATENCY=TREND_LATENCY))
+    time.sleep(1)
+    try:
+        api = sense_api.SenseApi('user@example.com', 'password')
+        print('{} monitors, {} rounds, trend latency {}s'.format(
+            len(api.monitors), ROUNDS, TREND_LATENCY))
+        for name, fetch in (('one by one', one_by_one), ('all at once', all_at_once)):
+            avg, worst, failed = bench(api, fetch)
+            print('  {:11}: avg {:.3f}s max {:.3f}s failed monitors {}'.format(
+                name, avg, worst, failed))
+        print('  day consumption: {}'.format(
+            [monitor.get_consumption_trend('DAY') for monitor in api.monitors]))
+
+        for monitor in api.monitors:
+            monitor.start_realtime_stream(0.5)
+        time.sleep(3)
+        print('  realtime updates: {}'.format(
+            [monitor.realtime_stream.updates for monitor in api.monitors]))
+        api.close()
+    finally:
+        standin.terminate()
+
+
+if __name__ == "__main__":
+    main()
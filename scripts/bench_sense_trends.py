@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Wall clock time to fetch Sense trends for all scales against the local
+# stand-in: one scale after the other, like SenseApi used to, and all at once
+# over the pooled session. The stand-in can make one scale slow, to show that
+# the others still get updated.
+#
+#   PYTHONPATH=/vagrant ./bench_sense_trends.py
+#   PYTHONPATH=/vagrant SLOW_SCALE=YEAR SLOW_LATENCY=30 ./bench_sense_trends.py
+
+import subprocess
+import sys
+import time
+from os import environ as env
+from os import path
+
+PORT = env.get('PORT', '18765')
+HTTP_PORT = str(int(PORT) + 1)
+env['SENSE_API_URL'] = 'http://localhost:%s/' % HTTP_PORT
+
+from ada import sense_api  # noqa: E402 (reads SENSE_API_URL)
+
+STANDIN = path.join(path.dirname(path.abspath(__file__)), 'sense_standin.py')
+ROUNDS = int(env.get('ROUNDS', '5'))
+TREND_LATENCY = env.get('TREND_LATENCY', '0.2')
+DEADLINE = float(env.get('DEADLINE', sense_api.TREND_DEADLINE))
+
+
+def sequential(api):
+    for scale in sense_api.VALID_SCALES:
+        api.get_trend_data(scale)
+    return sense_api.VALID_SCALES
+
+
+def concurrent(api):
+    return api.update_trend_data(DEADLINE)
+
+
+def bench(api, fetch):
+    elapsed, updated = [], None
+    for _ in range(ROUNDS):
+        start = time.monotonic()
+        try:
+            updated = fetch(api)
+        except Exception as e:
+            updated = 'failed: {}'.format(e)
+        elapsed.append(time.monotonic() - start)
+    return sum(elapsed) / ROUNDS, max(elapsed), updated
+
+
+def main():
+    standin = subprocess.Popen([sys.executable, STANDIN],
+                               env=dict(env, PORT=PORT, TREND_LATENCY=TREND_LATENCY))
+    time.sleep(1)
+    try:
+        api = sense_api.SenseApi('user@example.com', 'password')
+        print('{} rounds, trend latency {}s, slow scale {} {}s, deadline {}s'.format(
+            ROUNDS, TREND_LATENCY, env.get('SLOW_SCALE', '-'), env.get('SLOW_LATENCY', 0),
+            DEADLINE))
+        for name, fetch in (('sequential', sequential), ('concurrent', concurrent)):
+            avg, worst, updated = bench(api, fetch)
+            print('  {:10}: avg {:.3f}s max {:.3f}s updated {}'.format(name, avg, worst, updated))
+        api.close()
+    finally:
+        standin.terminate()
+
+
+if __name__ == "__main__":
+    main()
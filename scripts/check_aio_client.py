@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# Exercise ada.aioclient against a local broker, e.g.:
+#   mosquitto -p 1883 &
+#   PYTHONPATH=/vagrant IO_MQTT_HOST=localhost IO_MQTT_PORT=1883 ./check_aio_client.py
+
+import sys
+import time
+from os import environ as env
+
+from ada import log
+from ada.aioclient import AioClient
+
+IO_USERNAME = env.get('IO_USERNAME', 'username')
+IO_KEY = env.get('IO_KEY', 'aio_xxxxxx')
+HOST = env.get('IO_MQTT_HOST', 'localhost')
+PORT = int(env.get('IO_MQTT_PORT', '1883'))
+SECURE = env.get('IO_MQTT_SECURE', 'no') == 'yes'
+COUNT = int(env.get('COUNT', '1000'))
+WINDOW = int(env.get('IO_INFLIGHT_WINDOW', '20'))
+
+
+def main():
+    log.log_to_console()
+    client = AioClient(IO_USERNAME, IO_KEY, host=HOST, port=PORT, secure=SECURE,
+                       client_id='check_aio_client', inflight_window=WINDOW)
+    client.connect()
+    client.loop_background()
+    deadline = time.monotonic() + 10
+    while not client.is_connected():
+        if time.monotonic() > deadline:
+            print('unable to connect to {}:{}'.format(HOST, PORT))
+            sys.exit(1)
+        time.sleep(0.1)
+
+    # topics are built once, then reused
+    assert client.feed_topic('outside', 'home-temperature') is \
+        client.feed_topic('outside', 'home-temperature')
+
+    start = time.monotonic()
+    for i in range(COUNT):
+        client.publish('outside', i, 'home-temperature')
+    while client.rtt_count < COUNT and time.monotonic() - start < 30:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - start
+    count, rtt_avg, rtt_max = client.rtt_stats()
+    print('acked {}/{} publishes in {:.3f}s ({:.0f}/s) window {} rtt avg {:.4f}s max {:.4f}s'.format(
+        count, COUNT, elapsed, count / elapsed, WINDOW, rtt_avg, rtt_max))
+    client.disconnect()
+    client.loop_stop()
+    sys.exit(0 if count == COUNT else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Check fast reconnect of ada.aioclient against a local TLS broker.
+# Example mosquitto.conf:
+#   listener 8883
+#   cafile /tmp/tls/ca.crt
+#   certfile /tmp/tls/server.crt
+#   keyfile /tmp/tls/server.key
+#   allow_anonymous true
+#   persistence true
+#
+#   PYTHONPATH=/vagrant IO_MQTT_CA_CERTS=/tmp/tls/ca.crt ./check_aio_reconnect.py
+
+import socket
+import sys
+import time
+from os import environ as env
+
+from ada import aioclient
+from ada import log
+from ada.aioclient import AioClient
+
+HOST = env.get('IO_MQTT_HOST', 'localhost')
+PORT = int(env.get('IO_MQTT_PORT', '8883'))
+CA_CERTS = env.get('IO_MQTT_CA_CERTS')
+DROPS = int(env.get('DROPS', '3'))
+
+latencies = []
+
+
+def reconnect_latency(client, latency):
+    latencies.append((latency, client.tls_resumed, client.session_present))
+
+
+def wait_for(cond, timeout):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def main():
+    log.log_to_console()
+    client = AioClient('username', 'key', host=HOST, port=PORT, secure=True,
+                       client_id='check_aio_reconnect', clean_session=False,
+                       ssl_context=aioclient.tls_context(CA_CERTS))
+    client.on_reconnect_latency = reconnect_latency
+    client.connect()
+    client.loop_background()
+    if not wait_for(client.is_connected, 10):
+        print('unable to connect to {}:{}'.format(HOST, PORT))
+        sys.exit(1)
+    client.subscribe(client.feed_topic('check'), qos=1)
+
+    for drop in range(DROPS):
+        # simulate a network drop. paho notices and reconnects on its own
+        client._client.socket().shutdown(socket.SHUT_RDWR)
+        wait_for(lambda: not client.is_connected(), 5)
+        if not wait_for(client.is_connected, 180):
+            print('did not reconnect')
+            sys.exit(1)
+        client.publish('check', drop)
+        wait_for(lambda: len(latencies) > drop, 10)
+
+    for latency, tls_resumed, session_present in latencies:
+        print('reconnect latency {:.3f}s tls_resumed {} session_present {}'.format(
+            latency, tls_resumed, session_present))
+    client.disconnect()
+    client.loop_stop()
+    sys.exit(0 if len(latencies) == DROPS else 1)
+
+
+if __name__ == "__main__":
+    main()
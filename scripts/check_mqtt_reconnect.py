@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Restart a local mosquitto broker under the local mqtt adapter and check that it
+# reconnects with its persistent session: qos1 messages published right after the
+# restart must reach the event queue, and a reconnect duration metric is reported.
+#
+#   PYTHONPATH=/vagrant ./check_mqtt_reconnect.py
+
+import multiprocessing
+import subprocess
+import sys
+import tempfile
+import time
+from os import environ as env
+from os import path
+
+import paho.mqtt.client as mqtt
+
+from ada import mqttclient
+
+MOSQUITTO = env.get('MOSQUITTO', 'mosquitto')
+PORT = int(env.get('PORT', '18830'))
+COUNT = int(env.get('COUNT', '20'))
+TOPIC = '/check/mqtt_reconnect'
+
+
+class Child(multiprocessing.Process):
+    def __init__(self, eventq):
+        multiprocessing.Process.__init__(self)
+        self.eventq = eventq
+        self.cmdq = mqttclient.do_init(self.eventq.put)
+        mqttclient._state.topics = [TOPIC]
+
+    def run(self):
+        while True:
+            mqttclient.do_iterate()
+
+
+def start_broker(workdir):
+    conf = path.join(workdir, 'mosquitto.conf')
+    with open(conf, 'w') as f:
+        f.write('listener {}\nallow_anonymous true\n'.format(PORT))
+        f.write('persistence true\npersistence_location {}/\n'.format(workdir))
+    broker = subprocess.Popen([MOSQUITTO, '-c', conf])
+    time.sleep(0.5)
+    return broker
+
+
+def wait_event(eventq, name, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        event = eventq.get(True, max(0.1, deadline - time.monotonic()))
+        if event.name == name:
+            return event
+    return None
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+    env['MQTT_LOCAL_BROKER_IP'] = 'localhost'
+    env['MQTT_LOCAL_BROKER_PORT'] = str(PORT)
+    broker = start_broker(workdir)
+    eventq = multiprocessing.Queue(1000)
+    child = Child(eventq)
+    child.start()
+    try:
+        wait_event(eventq, 'MqttConnectEvent')
+
+        broker.terminate()
+        broker.wait()
+        broker = start_broker(workdir)
+        publisher = mqtt.Client()
+        publisher.connect('localhost', PORT)
+        publisher.loop_start()
+        for i in range(COUNT):
+            publisher.publish(TOPIC, str(i), 1).wait_for_publish()
+        publisher.loop_stop()
+
+        received, duration = set(), None
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and (len(received) < COUNT or duration is None):
+            try:
+                event = eventq.get(True, 1)
+            except Exception:
+                continue
+            if event.name == 'MqttMsgEvent':
+                received.add(event.params[2])
+            elif event.name == 'MetricEvent':
+                duration = event.params[1]
+        print('received {}/{} qos1 messages, reconnect duration {}s'.format(
+            len(received), COUNT, duration))
+        ok = len(received) == COUNT and duration is not None
+    finally:
+        child.terminate()
+        broker.terminate()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
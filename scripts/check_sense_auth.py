@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Check the Sense auth cache against the local stand-in: the first api logs in
+# and saves its token, the next one reuses it without logging in, and after the
+# stand-in restarts with a new token both the http api and the realtime stream
+# log in again on their 401.
+#
+#   PYTHONPATH=/vagrant ./check_sense_auth.py
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from os import environ as env
+from os import path
+
+PORT = env.get('PORT', '18765')
+env['SENSE_WS_URL'] = 'ws://localhost:%s/monitors/%%s/realtimefeed?access_token=%%s' % PORT
+env['SENSE_API_URL'] = 'http://localhost:%s/' % (int(PORT) + 1)
+
+from ada import sense_api  # noqa: E402 (reads SENSE_WS_URL and SENSE_API_URL)
+
+STANDIN = path.join(path.dirname(path.abspath(__file__)), 'sense_standin.py')
+
+
+def start_standin(token):
+    standin = subprocess.Popen([sys.executable, STANDIN], env=dict(env, PORT=PORT, TOKEN=token))
+    time.sleep(1)
+    return standin
+
+
+def check(what, ok):
+    print('{:50} {}'.format(what, 'ok' if ok else 'FAILED'))
+    return ok
+
+
+def main():
+    cache = sense_api.AuthCache(path.join(tempfile.mkdtemp(), 'sense_auth.json'))
+    standin = start_standin('first')
+    try:
+        api = sense_api.SenseApi('user@example.com', 'password', auth_cache=cache)
+        ok = check('first api logs in', api.authentications == 1)
+        ok &= check('cache is only readable by owner',
+                    os.stat(cache.filename).st_mode & 0o777 == 0o600)
+        api = sense_api.SenseApi('user@example.com', 'password', auth_cache=cache)
+        ok &= check('next api reuses cached token', api.authentications == 0)
+        ok &= check('cache is per username',
+                    cache.load('someone@example.com') is None)
+
+        api.start_realtime_stream(0.5)
+        ok &= check('realtime stream with cached token', bool(api.update_realtime()))
+        standin.terminate()
+        standin.wait()
+        standin = start_standin('second')
+        api.update_trend_data(force=True)
+        ok &= check('http api logs in again on 401', api.authentications == 1)
+        ok &= check('new token is cached',
+                    cache.load('user@example.com')['access_token'] == 'second')
+        stream = api.realtime_stream
+        updates = stream.updates
+        deadline = time.monotonic() + 30
+        while stream.updates == updates and time.monotonic() < deadline:
+            time.sleep(0.5)
+        ok &= check('realtime stream reconnects with new token', stream.updates > updates)
+        ok &= check('no more logins than needed', api.authentications == 1)
+        api.close()
+    finally:
+        standin.terminate()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
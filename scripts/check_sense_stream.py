@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Check the Sense realtime stream against the local stand-in: snapshots keep
+# coming, decimated to the interval, and the stream reconnects after the
+# stand-in drops the connection or restarts.
+#
+#   PYTHONPATH=/vagrant ./check_sense_stream.py
+
+import subprocess
+import sys
+import time
+from os import environ as env
+from os import path
+
+PORT = env.get('PORT', '18765')
+env['SENSE_WS_URL'] = 'ws://localhost:%s/monitors/%%s/realtimefeed?access_token=%%s' % PORT
+
+from ada import sense_api  # noqa: E402 (reads SENSE_WS_URL)
+
+STANDIN = path.join(path.dirname(path.abspath(__file__)), 'sense_standin.py')
+INTERVAL = float(env.get('INTERVAL', '1.0'))
+SECONDS = int(env.get('SECONDS', '10'))
+
+
+def start_standin(**knobs):
+    standin_env = dict(env, PORT=PORT, FRAME_RATE='10', **knobs)
+    standin = subprocess.Popen([sys.executable, STANDIN], env=standin_env)
+    time.sleep(1)
+    return standin
+
+
+def sample(api, seconds):
+    epochs = set()
+    for _ in range(seconds):
+        time.sleep(1)
+        epochs.add(api.update_realtime()['epoch'])
+        print('w {} solar_w {} active {}'.format(
+            api.active_power, api.active_solar_power, api.active_devices))
+    return epochs
+
+
+def main():
+    standin = start_standin(DROP_AFTER='25')
+    api = sense_api.SenseApi()
+    api.set_auth_data({'access_token': 'token', 'user_id': 1, 'monitors': [{'id': 1}]})
+    api.start_realtime_stream(INTERVAL)
+    try:
+        epochs = sample(api, SECONDS)
+        standin.terminate()
+        standin.wait()
+        standin = start_standin()
+        epochs |= sample(api, SECONDS)
+    finally:
+        stream = api.realtime_stream
+        api.stop_realtime_stream()
+        standin.terminate()
+    print('updates {} decimated {} reconnects {} distinct epochs {}'.format(
+        stream.updates, stream.decimated, stream.reconnects, len(epochs)))
+    ok = stream.reconnects >= 2 and stream.decimated and len(epochs) > SECONDS
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
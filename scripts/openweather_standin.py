@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the OpenWeather current weather api: the weather endpoint
+# for one city id and the group endpoint for many, with made up weather per
+# city. Responses carry an ETag that changes with dt, every UPDATE_INTERVAL
+# seconds, and a matching If-None-Match gets a 304. GROUP=no answers the
+# group endpoint with a 404, like for api keys without it. LATENCY is seconds
+# per request. GET /stats returns the requests served so far.
+#
+#   ./openweather_standin.py &
+#   export OPENWEATHER_URL='http://localhost:8780/'
+
+import json
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ as env
+from urllib.parse import parse_qs, urlparse
+
+HOST = env.get('HOST', 'localhost')
+PORT = int(env.get('PORT', '8780'))
+LATENCY = float(env.get('LATENCY', '0'))  # seconds per request
+GROUP = env.get('GROUP', 'yes') == 'yes'
+GROUP_SIZE = 20  # most city ids per group request
+UPDATE_INTERVAL = int(env.get('UPDATE_INTERVAL', '600'))  # seconds between new dt
+
+_requests = {'weather': 0, 'group': 0, 'not_modified': 0}
+_lock = threading.Lock()
+
+
+def weather(city_id, dt):
+    seed = zlib.crc32(city_id.encode())
+    temp = round(20 + seed % 600 / 10, 2)
+    return {'coord': {'lon': -(seed % 180), 'lat': seed % 90},
+            'weather': [{'id': 800, 'main': 'Clear', 'description': 'clear sky',
+                         'icon': '01d'}],
+            'base': 'stations',
+            'main': {'temp': temp, 'feels_like': temp - 1.5, 'temp_min': temp - 3,
+                     'temp_max': temp + 3, 'pressure': 1000 + seed % 40,
+                     'humidity': seed % 100},
+            'visibility': 10000, 'wind': {'speed': seed % 20, 'deg': seed % 360},
+            'clouds': {'all': seed % 100}, 'dt': dt,
+            'sys': {'type': 2, 'country': 'US', 'sunrise': dt - dt % 86400 + 36000,
+                    'sunset': dt - dt % 86400 + 80000},
+            'timezone': -14400, 'id': int(city_id), 'name': 'City {}'.format(city_id),
+            'cod': 200}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def _reply(self, status, body=None, headers=()):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _count(self, what):
+        with _lock:
+            _requests[what] += 1
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith('/stats'):
+            return self._reply(200, _requests)
+        time.sleep(LATENCY)
+        if not query.get('appid'):
+            return self._reply(401, {'cod': 401, 'message': 'Invalid API key'})
+        dt = int(time.time()) // UPDATE_INTERVAL * UPDATE_INTERVAL
+        city_ids = query.get('id', [''])[0].split(',')
+        if url.path.endswith('/weather'):
+            self._count('weather')
+            etag = '"{}-{}"'.format(city_ids[0], dt)
+            if self.headers.get('If-None-Match') == etag:
+                self._count('not_modified')
+                return self._reply(304)
+            return self._reply(200, weather(city_ids[0], dt), [('ETag', etag)])
+        if url.path.endswith('/group') and GROUP:
+            self._count('group')
+            if len(city_ids) > GROUP_SIZE:
+                return self._reply(400, {'cod': '400', 'message': 'too many ids'})
+            return self._reply(200, {'cnt': len(city_ids),
+                                     'list': [weather(city_id, dt) for city_id in city_ids]})
+        self._reply(404, {'cod': '404', 'message': 'Internal error'})
+
+    def log_message(self, *_args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    print('openweather stand-in on http://{}:{}'.format(HOST, PORT), flush=True)
+    try:
+        Server((HOST, PORT), Handler).serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the Sense api and realtime websocket, serving recorded
+# responses. The websocket replays recorded frames: the frames before the first
+# realtime_update once per connection, then the realtime_update frames in a
+# loop with a fresh epoch. The http api answers authenticate, trends, devices
+# and status from API_FIXTURES. Requests and websockets with a token other than
+# TOKEN get a 401. The account has MONITORS monitors, with ids 1 and up, each
+# with its own trend totals.
+#
+# Knobs for benchmarks and failure tests: LATENCY for every http request, plus
+# TREND_LATENCY for trends and SLOW_LATENCY for the SLOW_SCALE trend. A share
+# ERROR_RATE of http requests gets ERROR_STATUS, and a share WS_ERROR_RATE of
+# websocket handshakes gets a 503. FRAME_RATE realtime updates per second,
+# and connections closed after DROP_AFTER frames.
+#
+#   ./sense_standin.py &
+#   export SENSE_WS_URL='ws://localhost:8765/monitors/%s/realtimefeed?access_token=%s'
+#   export SENSE_API_URL='http://localhost:8766/'
+
+import asyncio
+import copy
+import http
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ as env
+from os import path
+from urllib.parse import parse_qs, urlparse
+
+import websockets
+
+FIXTURES_DIR = path.join(path.dirname(path.abspath(__file__)), 'fixtures')
+
+HOST = env.get('HOST', 'localhost')
+PORT = int(env.get('PORT', '8765'))
+HTTP_PORT = int(env.get('HTTP_PORT', PORT + 1))
+LATENCY = float(env.get('LATENCY', '0'))  # seconds per http request
+TREND_LATENCY = float(env.get('TREND_LATENCY', '0'))  # more seconds per trend request
+SLOW_SCALE = env.get('SLOW_SCALE', '')  # this trend scale takes SLOW_LATENCY more
+SLOW_LATENCY = float(env.get('SLOW_LATENCY', '0'))
+ERROR_RATE = float(env.get('ERROR_RATE', '0'))  # share of http requests that fail
+ERROR_STATUS = int(env.get('ERROR_STATUS', '503'))
+WS_ERROR_RATE = float(env.get('WS_ERROR_RATE', '0'))  # share of websocket handshakes that fail
+TOKEN = env.get('TOKEN', 'token')  # access token handed out by authenticate
+MONITORS = int(env.get('MONITORS', '1'))  # monitors of the account
+API_FIXTURES = env.get('API_FIXTURES', path.join(FIXTURES_DIR, 'sense_api.json'))
+FRAMES = env.get('FRAMES', path.join(FIXTURES_DIR, 'sense_frames.jsonl'))
+FRAME_RATE = float(env.get('FRAME_RATE', '2'))  # realtime updates per second
+DROP_AFTER = int(env.get('DROP_AFTER', '0'))  # close connection after this many frames
+
+MONITOR_PATH = re.compile(r'/app/monitors/(\d+)/(devices|status)$')
+
+
+def load_frames(filename):
+    with open(filename) as f:
+        frames = [json.loads(line) for line in f if line.strip()]
+    first = next(i for i, frame in enumerate(frames) if frame['type'] == 'realtime_update')
+    return frames[:first], frames[first:]
+
+
+def load_fixtures(filename):
+    with open(filename) as f:
+        fixtures = json.load(f)
+    auth = fixtures['authenticate']
+    auth['access_token'] = TOKEN
+    monitor = auth['monitors'][0]
+    auth['monitors'] = [dict(monitor, id=i + 1, serial_number='N%09d' % (i + 1))
+                        for i in range(MONITORS)]
+    return fixtures
+
+
+FIXTURES = load_fixtures(API_FIXTURES)
+
+
+def check_token(connection, request):
+    if random.random() < WS_ERROR_RATE:
+        return connection.respond(http.HTTPStatus.SERVICE_UNAVAILABLE, 'injected error\n')
+    token = parse_qs(urlparse(request.path).query).get('access_token', [''])[0]
+    if token != TOKEN:
+        return connection.respond(http.HTTPStatus.UNAUTHORIZED, 'bad access token\n')
+    return None
+
+
+async def realtimefeed(websocket):
+    greeting, updates = load_frames(FRAMES)
+    sent = 0
+    try:
+        for frame in greeting:
+            await websocket.send(json.dumps(frame))
+        while not DROP_AFTER or sent < DROP_AFTER:
+            frame = updates[sent % len(updates)]
+            frame['payload']['epoch'] = int(time.time())
+            await websocket.send(json.dumps(frame))
+            sent += 1
+            await asyncio.sleep(1 / FRAME_RATE)
+    except websockets.ConnectionClosed:
+        pass  # client went away
+
+
+def trends(monitor_id, scale):
+    body = copy.deepcopy(FIXTURES['trends'][scale])
+    for key in ('consumption', 'production'):
+        body[key]['total'] = round(body[key]['total'] * monitor_id, 1)
+    return body
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _injected_error(self):
+        time.sleep(LATENCY)
+        if random.random() < ERROR_RATE:
+            self._reply(ERROR_STATUS, {'status': 'error', 'error_reason': 'injected'})
+            return True
+        return False
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self._injected_error():
+            return
+        if self.path.rstrip('/').endswith('/authenticate'):
+            return self._reply(200, FIXTURES['authenticate'])
+        self._reply(404, {'status': 'error'})
+
+    def do_GET(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urlparse(self.path)
+        if self._injected_error():
+            return
+        if self.headers.get('Authorization') != 'bearer {}'.format(TOKEN):
+            return self._reply(401, {'status': 'error', 'error_reason': 'Unauthorized'})
+        if url.path.endswith('/app/history/trends'):
+            query = parse_qs(url.query)
+            scale, monitor_id = query['scale'][0], int(query['monitor_id'][0])
+            if not 0 < monitor_id <= MONITORS:
+                return self._reply(404, {'status': 'error'})
+            time.sleep(TREND_LATENCY + (SLOW_LATENCY if scale == SLOW_SCALE else 0))
+            return self._reply(200, trends(monitor_id, scale))
+        match = MONITOR_PATH.search(url.path)
+        if match and 0 < int(match.group(1)) <= MONITORS:
+            return self._reply(200, FIXTURES[match.group(2)])
+        self._reply(404, {'status': 'error'})
+
+    def log_message(self, *_args):
+        pass
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, _request, _client_address):
+        pass  # clients giving up on a slow reply
+
+
+async def main():
+    api = ApiServer((HOST, HTTP_PORT), ApiHandler)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    async with websockets.serve(realtimefeed, HOST, PORT, process_request=check_token):
+        print('sense stand-in on ws://{}:{} and http://{}:{}'.format(
+            HOST, PORT, HOST, HTTP_PORT), flush=True)
+        await asyncio.Future()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass